@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+  FileName     [ benchmark.py ]
+  PackageName  [ final ]
+  Synopsis     [ Measure the throughput and the val mAP of the feature extractor variants ]
+
+  Usage:
+  - python3 benchmark.py precision
+  >> Throughput (images/s) of FeatureExtractorFace in fp32 and bf16, and the feature deviation.
+
+  - python3 benchmark.py --dataroot ./IMDb_resize/ --model_features <resnet50.pth> --model_classifier <classifier.pth> precision --val
+  >> Besides, the val mAP (cosine / rerank) of each precision, and the delta against fp32.
+
+  - python3 benchmark.py --dataroot ./IMDb_resize/ --model_features <resnet50.pth> --model_classifier <classifier.pth> quantize --val
+  >> Throughput and val mAP of the static int8 FeatureExtractorQuantized against fp32 (CPU).
+"""
+import argparse
+import os
+import time
+
+import torch
+import torchvision.transforms as transforms
+from torch.utils.data import DataLoader
+
+import inference_csv
+import utils
+from imdb import CandDataset, CastDataset, calibration_images
+from model_res50 import Classifier, FeatureExtractorFace, FeatureExtractorQuantized
+
+transform = transforms.Compose([
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+def throughput(model, device, batchsize=32, iters=10, warmup=2, size=224) -> float:
+    """
+      Measure the throughput of the model with random images.
+
+      Return:
+      - images/s
+    """
+    images = torch.randn(batchsize, 3, size, size, device=device)
+
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(images)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+        start = time.time()
+        for _ in range(iters):
+            model(images)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    return batchsize * iters / (time.time() - start)
+
+def deviation(model, reference, device, batchsize=8, size=224) -> (float, float):
+    """
+      Compare the features of the model with the reference model.
+
+      Return:
+      - max absolute difference
+      - min cosine similarity
+    """
+    images = torch.randn(batchsize, 3, size, size, device=device)
+
+    with torch.no_grad():
+        x, y = model(images), reference(images)
+
+    return (x - y).abs().max().item(), torch.nn.functional.cosine_similarity(x, y, dim=1).min().item()
+
+def val_mAP(feature_extractor, classifier, device, opt) -> list:
+    """
+      Run inference_csv.test on the val set.
+
+      Return:
+      - [cosine mAP, rerank mAP]
+    """
+    cand_data = CandDataset(data_path=os.path.join(opt.dataroot, 'val'), drop_others=False, transform=transform, action='val')
+    cast_data = CastDataset(data_path=os.path.join(opt.dataroot, 'val'), drop_others=False, transform=transform, action='val')
+    candloader = DataLoader(cand_data, batch_size=opt.batchsize, shuffle=False, num_workers=opt.num_workers,
+                            pin_memory=torch.cuda.is_available())
+    castloader = DataLoader(cast_data, batch_size=1, shuffle=False, num_workers=opt.num_workers,
+                            pin_memory=torch.cuda.is_available())
+
+    test_opt = argparse.Namespace(action='val', dataroot=opt.dataroot, out_folder=opt.out_folder,
+                                  tta=False)
+
+    with torch.no_grad():
+        return inference_csv.test(castloader, candloader, cast_data, cand_data,
+                                  feature_extractor, classifier, test_opt, device,
+                                  feature_dim=opt.out_dim, k1=40, k2=6, lambda_value=0.1, mute=True)
+
+def build_models(device, opt, **kwargs):
+    feature_extractor = FeatureExtractorFace(model=opt.pretrain, **kwargs)
+    classifier = Classifier(fc_in_features=2048, fc_out=opt.out_dim)
+
+    if opt.model_features:
+        feature_extractor = utils.load_network(feature_extractor, opt.model_features)
+
+    if opt.model_classifier:
+        classifier = utils.load_network(classifier, opt.model_classifier)
+
+    return feature_extractor.to(device).eval(), classifier.to(device).eval()
+
+def measure(variants: dict, device, opt) -> dict:
+    """
+      Measure each variant of the feature extractor, the first one is the reference.
+
+      Params:
+      - variants: {name: function return (feature_extractor, classifier)}
+
+      Return:
+      - results: {name: {'images/s', 'max_abs_diff', 'min_cosine', 'mAP'}}
+    """
+    results, reference = {}, None
+
+    for name, build in variants.items():
+        feature_extractor, classifier = build()
+        results[name] = {'images/s': throughput(feature_extractor, device, opt.batchsize, opt.iters)}
+
+        if reference is None:
+            reference = feature_extractor
+        else:
+            results[name]['max_abs_diff'], results[name]['min_cosine'] = deviation(feature_extractor, reference, device)
+
+        if opt.val:
+            results[name]['mAP'] = val_mAP(feature_extractor, classifier, device, opt)
+
+    report(results)
+
+    return results
+
+def report(results: dict):
+    """ Print the results, compared with the first one """
+    base = next(iter(results.values()))
+
+    for name, result in results.items():
+        message = '[{:5}] {:8.2f} images/s ({:.2f}x)'.format(
+            name, result['images/s'], result['images/s'] / base['images/s'])
+
+        if 'max_abs_diff' in result:
+            message += ' max_abs_diff: {:.4f} min_cosine: {:.6f}'.format(result['max_abs_diff'], result['min_cosine'])
+
+        if 'mAP' in result:
+            message += ' [Cosine] mAP: {:.2%} ({:+.2%}) [Rerank] mAP: {:.2%} ({:+.2%})'.format(
+                result['mAP'][0], result['mAP'][0] - base['mAP'][0],
+                result['mAP'][1], result['mAP'][1] - base['mAP'][1])
+
+        print(message)
+
+    return
+
+def precision(opt):
+    device = utils.selectDevice()
+    print('Device: {}'.format(device))
+
+    variants = {name: (lambda name=name: build_models(device, opt, precision=name)) for name in opt.precisions}
+
+    return measure(variants, device, opt)
+
+def quantize(opt):
+    device = torch.device('cpu')
+    images = calibration_images(os.path.join(opt.dataroot, 'train'), transform, opt.calibration_size)
+
+    def build_quantized():
+        feature_extractor, classifier = build_models(device, opt)
+        return FeatureExtractorQuantized(feature_extractor, images).eval(), classifier
+
+    variants = {
+        'fp32': lambda: build_models(device, opt),
+        'int8': build_quantized,
+    }
+
+    return measure(variants, device, opt)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='benchmark.py', description='Benchmark')
+
+    # I/O Setting
+    parser.add_argument('--pretrain', default='pretrain/resnet50_ft_weight.pkl', help='VGGFace2 pretrained weights')
+    parser.add_argument('--model_features', help='model checkpoint path to extract features')
+    parser.add_argument('--model_classifier', help='model checkpoint path to classifier')
+    parser.add_argument('--dataroot', default='./IMDb_resize/', type=str, help='Directory of dataroot')
+    parser.add_argument('--out_dim', default=1024, type=int, help='to set the output dimensions of FC Layer')
+    parser.add_argument('--out_folder', default='./inference/benchmark/', help='output csv folder name')
+
+    # Benchmark Setting
+    parser.add_argument('--batchsize', default=32, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--num_workers', default=0, type=int)
+    parser.add_argument('--gpu', default='0', type=str, help='')
+
+    subparser = parser.add_subparsers(dest='command', help='Benchmark item')
+    subparser.required = True
+
+    precision_parser = subparser.add_parser('precision', help='fp32 vs bf16 autocast')
+    precision_parser.add_argument('--precisions', default=['fp32', 'bf16'], nargs='*', choices=['fp32', 'bf16'])
+    precision_parser.add_argument('--val', action='store_true', help='measure the val mAP of each precision')
+
+    quantize_parser = subparser.add_parser('quantize', help='fp32 vs static int8 (CPU)')
+    quantize_parser.add_argument('--calibration_size', default=512, type=int, help='number of train images to calibrate')
+    quantize_parser.add_argument('--val', action='store_true', help='measure the val mAP of each model')
+
+    opt = parser.parse_args()
+    os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpu
+
+    utils.details(opt)
+
+    if opt.command == 'precision':
+        if 'fp32' not in opt.precisions:
+            opt.precisions.insert(0, 'fp32')
+
+        precision(opt)
+
+    if opt.command == 'quantize':
+        quantize(opt)
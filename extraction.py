@@ -0,0 +1,398 @@
+"""
+  FileName     [ extraction.py ]
+  PackageName  [ final ]
+  Synopsis     [ Shared feature extraction routines for training / inference ]
+
+  Usage:
+  - model = compose(feature_extractor, classifier)
+  - features = extract(model, images, device)
+  >> images (N x 3 x H x W) to features (N x dim), on CPU.
+
+  - features, (labels, names) = extract_loader(model, candloader, device)
+  >> Features of all the batches, and the other fields of the batches concatenated.
+
+  - model = TestTimeAugmentation(model, flip=True, scales=[1.0, 1.25])
+  >> For each scale, the original and the flipped images are stacked into one batch,
+     the embeddings of all the views are summed and L2-normalized.
+
+  - engine = PipelinedExtractor(decode_threads=4, prefetch=4)
+  - features, fields = extract_loader(model, candloader, device, engine=engine)
+  >> The images are decoded by a thread pool, collated into batches and queued
+     (at most 'prefetch' batches) while the model runs; print(engine.summary())
+     shows the per-stage timings.
+
+  The model runs in torch.inference_mode with channels_last memory format.
+  On GPU, the batches pinned by the loaders (DataLoader(pin_memory=True), or
+  the batcher of PipelinedExtractor) are copied with non_blocking transfers,
+  and the outputs are copied back into one pinned host buffer reused over the
+  runs (host_buffer).
+"""
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+import utils
+
+def inference_mode():
+    """ torch.inference_mode if available (torch >= 1.9), otherwise torch.no_grad """
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+
+    return torch.no_grad()
+
+def compose(*modules) -> nn.Module:
+    """
+      Chain the modules (skip the None), e.g. compose(feature_extractor, classifier)
+
+      Return:
+      - model: nn.Sequential
+    """
+    return nn.Sequential(*[module for module in modules if module is not None])
+
+def prepare(model, channels_last=True):
+    """
+      Set the model in eval mode, and convert the conv weights to channels_last.
+    """
+    model.eval()
+
+    if channels_last and not isinstance(model, torch.jit.ScriptModule):
+        model.to(memory_format=torch.channels_last)
+
+    return model
+
+def to_device(x: torch.Tensor, device, channels_last=True) -> torch.Tensor:
+    """ Move the batch to the device, non_blocking if it is already pinned (e.g. DataLoader(pin_memory=True)) """
+    device = torch.device(device)
+
+    if device.type == 'cuda' and x.is_pinned():
+        x = x.to(device, non_blocking=True)
+    else:
+        x = x.to(device)
+
+    if channels_last and x.dim() == 4:
+        x = x.contiguous(memory_format=torch.channels_last)
+
+    return x
+
+class HostBuffer(object):
+    def __init__(self):
+        '''
+          Pinned host buffer for the outputs (N x dim) of a run, reused over
+          the runs and grown (doubled) when the outputs do not fit.
+
+          - reset() : start a new run
+          - append(): non_blocking copy of the device output after the previous ones
+          - result(): synchronize and return a copy of the outputs of the run
+        '''
+        self.buffer = None
+        self.size = 0
+
+    def reset(self):
+        self.size = 0
+
+    def _reserve(self, x: torch.Tensor):
+        n = self.size + x.shape[0]
+
+        if (self.buffer is not None and self.buffer.dtype == x.dtype
+                and self.buffer.shape[1:] == x.shape[1:] and self.buffer.shape[0] >= n):
+            return
+
+        capacity = n if self.buffer is None else max(n, 2 * self.buffer.shape[0])
+        buffer = torch.empty((capacity, ) + tuple(x.shape[1:]), dtype=x.dtype, pin_memory=True)
+
+        if self.size > 0:
+            # The pending copies into the old buffer must be done
+            torch.cuda.synchronize()
+            buffer[:self.size].copy_(self.buffer[:self.size])
+
+        self.buffer = buffer
+
+    def append(self, x: torch.Tensor):
+        self._reserve(x)
+        self.buffer[self.size:self.size + x.shape[0]].copy_(x, non_blocking=True)
+        self.size += x.shape[0]
+
+    def result(self) -> torch.Tensor:
+        torch.cuda.synchronize()
+
+        if self.buffer is None:
+            return torch.tensor([])
+
+        return self.buffer[:self.size].clone()
+
+# Shared by the runs of the process
+host_buffer = HostBuffer()
+
+def extract(model, images: torch.Tensor, device, channels_last=True) -> torch.Tensor:
+    """
+      Params:
+      - model: images to features, in eval mode (see prepare())
+      - images: Tensor _N x 3 x H x W (or N x dim features)
+
+      Return:
+      - features: Tensor _N x dim, on CPU
+    """
+    with inference_mode():
+        out = model(to_device(images, device, channels_last))
+        out = out.reshape(out.shape[0], -1)
+
+    if out.device.type != 'cuda':
+        return out
+
+    host_buffer.reset()
+    host_buffer.append(out)
+
+    return host_buffer.result()
+
+def extract_loader(model, loader, device, channels_last=True, engine=None) -> (torch.Tensor, list):
+    """
+      Run the model on the first field of each batch of the loader.
+
+      Params:
+      - engine: PipelinedExtractor, if given, load loader.dataset (in order,
+                with loader.batch_size) by the engine instead of the loader
+
+      Return:
+      - features: Tensor _N x dim, on CPU
+      - fields: the other fields of the batches, tensors are concatenated,
+                others (e.g. tuple of names) are extended as list
+    """
+    if engine is not None:
+        return engine.run(model, loader.dataset, device, loader.batch_size, channels_last)
+
+    outputs, fields = [], None
+    host_buffer.reset()
+
+    with inference_mode():
+        for batch in loader:
+            out = model(to_device(batch[0], device, channels_last))
+            out = out.reshape(out.shape[0], -1)
+
+            if out.device.type == 'cuda':
+                host_buffer.append(out)
+            else:
+                outputs.append(out)
+
+            if fields is None:
+                fields = [[] for _ in batch[1:]]
+
+            for field, value in zip(fields, batch[1:]):
+                if isinstance(value, torch.Tensor):
+                    field.append(value)
+                else:
+                    field.extend(value)
+
+    if fields is None:
+        return torch.tensor([]), []
+
+    fields = [torch.cat(field, dim=0) if len(field) > 0 and isinstance(field[0], torch.Tensor) else field
+              for field in fields]
+
+    if host_buffer.size > 0:
+        return host_buffer.result(), fields
+
+    return torch.cat(outputs, dim=0), fields
+
+class TestTimeAugmentation(nn.Module):
+    def __init__(self, model, flip=True, scales=(1.0, )):
+        '''
+          - model : images to features
+          - flip  : add the horizontal flipped images
+          - scales: rescale the images by the factors, one forward for each scale
+        '''
+        super(TestTimeAugmentation, self).__init__()
+
+        self.model = model
+        self.flip = flip
+        self.scales = list(scales)
+
+    def forward(self, x):
+        n = x.shape[0]
+
+        # Original and flipped images in one batch: 2N x 3 x H x W
+        if self.flip:
+            x = torch.cat((x, utils.fliplr(x)), dim=0)
+
+        features = 0
+        for scale in self.scales:
+            images = x
+            if scale != 1:
+                images = F.interpolate(x, scale_factor=scale, mode='bilinear', align_corners=False)
+
+            out = self.model(images)
+            out = out.reshape(out.shape[0], -1).float()
+
+            features = features + out.reshape(-1, n, out.shape[1]).sum(dim=0)
+
+        return F.normalize(features, p=2, dim=1)
+
+class PipelinedExtractor(object):
+    def __init__(self, decode_threads=4, prefetch=4):
+        '''
+          Pipelined extraction: decode threads -> batcher -> model.
+
+          - decode_threads : number of threads to load (decode + transform) the images
+          - prefetch : maximum number of batches waiting for the model
+
+          The timings of each stage are accumulated over the runs:
+          - decode  : sum of the time spent in dataset[index] of all threads
+          - collate : time to stack the samples into batches
+          - wait    : time of the model waiting for the next batch
+          - transfer: time to move the batches to the device
+          - forward : time of the model forward (and the copy back to host)
+          - total   : wall time
+        '''
+        self.decode_threads = decode_threads
+        self.prefetch = prefetch
+        self.timings = collections.OrderedDict(
+            (stage, 0.0) for stage in ('decode', 'collate', 'wait', 'transfer', 'forward', 'total'))
+        self.images = 0
+        self._lock = threading.Lock()
+
+    def _load(self, dataset, index):
+        start = time.time()
+        sample = dataset[index]
+
+        with self._lock:
+            self.timings['decode'] += time.time() - start
+
+        return sample
+
+    def _batcher(self, dataset, batchsize, batches: queue.Queue, stop: threading.Event, pin_memory=False):
+        ''' Submit the samples to the decode threads in order, collate them (into pinned memory) and put the batches '''
+        with concurrent.futures.ThreadPoolExecutor(self.decode_threads) as executor:
+            pending = collections.deque()
+            indices = iter(range(len(dataset)))
+
+            # Bounded in-flight samples: the batches in the queue + the one being collected
+            max_pending = batchsize * (self.prefetch + 1)
+
+            try:
+                while not stop.is_set():
+                    for index in indices:
+                        pending.append(executor.submit(self._load, dataset, index))
+                        if len(pending) >= max_pending:
+                            break
+
+                    if len(pending) == 0:
+                        break
+
+                    samples = [pending.popleft().result() for _ in range(min(batchsize, len(pending)))]
+
+                    start = time.time()
+                    batch = default_collate(samples)
+                    if pin_memory:
+                        batch[0] = batch[0].pin_memory()
+                    self.timings['collate'] += time.time() - start
+
+                    batches.put(batch)
+
+            except Exception as e:
+                batches.put(e)
+
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        batches.put(None)
+
+    def run(self, model, dataset, device, batchsize=32, channels_last=True) -> (torch.Tensor, list):
+        '''
+          Same as extract_loader(), the samples of the dataset are taken in order.
+
+          Return:
+          - features: Tensor _N x dim, on CPU
+          - fields: the other fields of the batches
+        '''
+        start = time.time()
+
+        batches, stop = queue.Queue(maxsize=self.prefetch), threading.Event()
+        cuda = torch.device(device).type == 'cuda'
+        batcher = threading.Thread(target=self._batcher, args=(dataset, batchsize, batches, stop, cuda), daemon=True)
+        batcher.start()
+
+        def consume():
+            while True:
+                tick = time.time()
+                batch = batches.get()
+                self.timings['wait'] += time.time() - tick
+
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+
+                yield batch
+
+        try:
+            outputs, fields = [], None
+            host_buffer.reset()
+
+            with inference_mode():
+                for batch in consume():
+                    tick = time.time()
+                    images = to_device(batch[0], device, channels_last)
+                    self.timings['transfer'] += time.time() - tick
+
+                    tick = time.time()
+                    out = model(images)
+                    out = out.reshape(out.shape[0], -1)
+                    if cuda:
+                        host_buffer.append(out)
+                        torch.cuda.synchronize()
+                    else:
+                        outputs.append(out)
+                    self.timings['forward'] += time.time() - tick
+
+                    if fields is None:
+                        fields = [[] for _ in batch[1:]]
+
+                    for field, value in zip(fields, batch[1:]):
+                        if isinstance(value, torch.Tensor):
+                            field.append(value)
+                        else:
+                            field.extend(value)
+
+                    self.images += images.shape[0]
+
+        finally:
+            stop.set()
+            # Unblock the batcher if the model has stopped early
+            while batcher.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+            self.timings['total'] += time.time() - start
+
+        if fields is None:
+            return torch.tensor([]), []
+
+        fields = [torch.cat(field, dim=0) if len(field) > 0 and isinstance(field[0], torch.Tensor) else field
+                  for field in fields]
+
+        if cuda:
+            return host_buffer.result(), fields
+
+        return torch.cat(outputs, dim=0), fields
+
+    def summary(self) -> str:
+        '''
+          The per-stage timings, and whether the extraction is decode-bound
+          (the model waits for the batches) or compute-bound.
+        '''
+        total = max(self.timings['total'], 1e-9)
+        compute = self.timings['transfer'] + self.timings['forward']
+        bound = 'decode-bound' if self.timings['wait'] > compute else 'compute-bound'
+
+        stages = ' '.join('{}: {:.2f}s'.format(stage, value) for stage, value in self.timings.items())
+        return '[PipelinedExtractor] {} images, {:.2f} images/s, {} ({} decode threads) {}'.format(
+            self.images, self.images / total, bound, self.decode_threads, stages)
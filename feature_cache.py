@@ -0,0 +1,164 @@
+"""
+  FileName     [ feature_cache.py ]
+  PackageName  [ final ]
+  Synopsis     [ Memoize the outputs of the fixed feature extractor ]
+
+  Usage:
+  - cache = FeatureCache(namespace=repr(transform), spill_dir='./cache/', max_items=100000)
+  - features, misses = cache.get(keys)
+  - cache.put(keys, features)
+  >> The features are kept in memory, the least recently used ones are spilled to
+     '<spill_dir>/<namespace hash>/<key hash>.npy' when max_items is exceeded.
+
+  - cache.flush()
+  >> Write the features in memory to the spill_dir too, for the next runs.
+"""
+import collections
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+# The transforms which always output the same tensor from the same image
+DETERMINISTIC_TRANSFORMS = (
+    transforms.Resize,
+    transforms.CenterCrop,
+    transforms.ToTensor,
+    transforms.Normalize,
+)
+
+def is_deterministic(transform) -> bool:
+    """
+      Check whether the transform pipeline has no random augmentation,
+      i.e. whether the image path is enough to identify the feature.
+    """
+    if transform is None:
+        return True
+
+    if isinstance(transform, transforms.Compose):
+        return all(is_deterministic(t) for t in transform.transforms)
+
+    return isinstance(transform, DETERMINISTIC_TRANSFORMS)
+
+def _hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def file_hash(path, chunk_size=1 << 20) -> str:
+    """ sha1 of the file content, e.g. to identify a checkpoint """
+    h = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def state_hash(network) -> str:
+    """ sha1 of the parameters and buffers of the network, e.g. to identify the weights in memory """
+    h = hashlib.sha1()
+
+    for key, value in sorted(network.state_dict().items()):
+        h.update(key.encode('utf-8'))
+        h.update(value.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+
+    return h.hexdigest()
+
+class FeatureCache(object):
+    def __init__(self, namespace='', spill_dir=None, max_items=None):
+        '''
+          - namespace : everything except the key which changes the feature (e.g. transform config)
+          - spill_dir : the folder to spill the features, keep all in memory if None
+          - max_items : the maximum number of features in memory
+        '''
+        self.namespace = namespace
+        self.max_items = max_items
+        self.memory = collections.OrderedDict()     # key -> torch.Tensor (cpu)
+        self.spilled = set()
+
+        self.spill_dir = None
+        if spill_dir is not None:
+            self.spill_dir = os.path.join(spill_dir, _hash(namespace)[:16])
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+            # Re-use the features spilled by the previous runs
+            self.spilled = set(f[:-4] for f in os.listdir(self.spill_dir) if f.endswith('.npy'))
+
+        self.hits, self.misses = 0, 0
+
+    def _spill_path(self, key) -> str:
+        return os.path.join(self.spill_dir, _hash(key) + '.npy')
+
+    def __len__(self):
+        # The flushed features are both in memory and on disk
+        return len(self.spilled | set(_hash(key) for key in self.memory))
+
+    def __contains__(self, key):
+        return key in self.memory or (self.spill_dir is not None and _hash(key) in self.spilled)
+
+    def get(self, keys: list) -> (list, list):
+        '''
+          Return:
+          - features : list of torch.Tensor, None if the key is not cached
+          - misses   : list of the indices of the keys which are not cached
+        '''
+        features, misses = [], []
+
+        for i, key in enumerate(keys):
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                features.append(self.memory[key])
+            elif self.spill_dir is not None and _hash(key) in self.spilled:
+                features.append(torch.from_numpy(np.load(self._spill_path(key))))
+            else:
+                features.append(None)
+                misses.append(i)
+
+        self.hits += len(keys) - len(misses)
+        self.misses += len(misses)
+
+        return features, misses
+
+    def put(self, keys: list, features: torch.Tensor):
+        '''
+          Params:
+          - keys     : list of keys, len = N
+          - features : torch.Tensor, N x dim
+        '''
+        features = features.detach().cpu()
+
+        for key, feature in zip(keys, features):
+            self.memory[key] = feature.clone()
+
+        if self.max_items is None:
+            return
+
+        while len(self.memory) > self.max_items:
+            key, feature = self.memory.popitem(last=False)
+
+            if self.spill_dir is not None:
+                np.save(self._spill_path(key), feature.numpy())
+                self.spilled.add(_hash(key))
+
+        return
+
+    def flush(self):
+        '''
+          Write the features in memory which are not on disk yet to the spill_dir
+          (they are kept in memory as well), so that the next runs can re-use them.
+        '''
+        if self.spill_dir is None:
+            return
+
+        for key, feature in self.memory.items():
+            if _hash(key) not in self.spilled:
+                np.save(self._spill_path(key), feature.numpy())
+                self.spilled.add(_hash(key))
+
+        return
+
+    def summary(self) -> str:
+        total = max(self.hits + self.misses, 1)
+        return 'FeatureCache: {} in memory, {} on disk, hit rate {:.2%} ({}/{})'.format(
+            len(self.memory), len(self.spilled), self.hits / total, self.hits, total)
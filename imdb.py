@@ -296,23 +296,59 @@ class CandDataset(Dataset):
                     - label_mapped
                     - index
                 '''
-                casts = self.all_casts[self.mv]
                 candidates = self.all_candidates[self.mv]
 
                 # randomly generate an index to get candidate image
                 index = int(torch.randint(0, len(candidates[0]), (1,)).tolist()[0])
 
-                image_path, cast = candidates.iat[index, 0], candidates.iat[index, 1]
-                image = Image.open(os.path.join(self.root_path, image_path))
-                if self.transform:
-                    image = self.transform(image)
-
-                # string label >> int label
-                label_mapped = casts.index[casts[0] == cast].tolist()[0] 
-                # print('label check : [{} >> {}]'.format(cast, label_mapped))
+                image, label_mapped = self.get_train_item(index)
                 
                 return image, label_mapped, index
 
+    def image_names(self):
+        '''
+          Return the img_name of all candidates of self.mv, in the order of __getitem__
+          (action = 'test' / 'save' / 'val')
+        '''
+        if self.action == 'test':
+            return [candidate_file[:-4] for candidate_file in self.candidate_file_list]
+
+        return [image_path.split('/')[-1].split('.')[0] for image_path in self.candidate_df['index']]
+
+    def image_path(self, index):
+        '''
+          Return the path of the index-th candidate of self.mv (action = 'train'),
+          relative to the root_path.
+        '''
+        return self.all_candidates[self.mv].iat[index, 0]
+
+    def get_label(self, index):
+        '''
+          Return the label_mapped of the index-th candidate of self.mv (action = 'train')
+        '''
+        casts = self.all_casts[self.mv]
+        cast = self.all_candidates[self.mv].iat[index, 1]
+
+        # string label >> int label
+        label_mapped = casts.index[casts[0] == cast].tolist()[0] 
+        # print('label check : [{} >> {}]'.format(cast, label_mapped))
+
+        return label_mapped
+
+    def get_train_item(self, index):
+        '''
+          Load the index-th candidate of self.mv (action = 'train')
+
+          Return:
+          - image
+          - label_mapped
+        '''
+        image = Image.open(os.path.join(self.root_path, self.image_path(index)))
+        if self.transform:
+            image = self.transform(image)
+
+        return image, self.get_label(index)
+
 # To pop the cast images
 class CastDataset(Dataset):
     def __init__(self, data_path, drop_others=True, transform=None, debug=False, action='train', load_feature=False):
@@ -405,6 +441,40 @@ class CastDataset(Dataset):
     def __len__(self):
         return len(self.movies)
 
+    def image_paths(self, moviename):
+        '''
+          Return the paths of the cast images of the movie, relative to the root_path.
+          (action = 'train' / 'val' / 'save')
+        '''
+        casts_df = self.all_casts[moviename]
+        return [casts_df.iat[idx, 0] for idx in range(casts_df.shape[0])]
+
+    def labels(self, moviename) -> torch.Tensor:
+        '''
+          Return the label_mapped of the cast images of the movie, in the order of image_paths()
+          (action = 'train' / 'val' / 'save'), without loading the images.
+        '''
+        casts_df = self.all_casts[moviename]
+        num_casts = casts_df.shape[0]
+
+        label_list = []
+        for idx in range(num_casts):
+            # string label >> int label
+            label_mapped = casts_df.index[casts_df[0] == casts_df.iat[idx, 1]].tolist()
+            label_list.append(label_mapped[0] if len(label_mapped) > 0 else num_casts)
+
+        return torch.tensor(label_list, dtype=torch.long)
+
+    def get_image(self, image_path):
+        '''
+          Load the cast image, image_path is relative to the root_path (see image_paths())
+        '''
+        image = Image.open(os.path.join(self.root_path, image_path))
+        if self.transform:
+            image = self.transform(image)
+
+        return image
+
     def __getitem__(self, index):
         moviename = self.movies[index]
 
@@ -523,6 +593,107 @@ class CastDataset(Dataset):
                     
                 return images, labels, moviename    #, img_names
 
+# To hold all the features of a split in memory
+class FeatureBank(object):
+    def __init__(self, data_path, drop_others=True, device=torch.device('cpu')):
+        '''
+          Load the features generated by preprocess_features.py once, and
+          concatenate the features of all movies into 2 tensors.
+
+          Input:
+            - data_path = '~./feature_np/<model>/train  (or val)
+            - drop_others : drop the candidates labeled "others" (label == num_casts)
+
+          Attributes:
+            - cast_features (tensor) : (total_cast_num, 2048)
+            - cand_features (tensor) : (total_cand_num, 2048)
+            - cand_labels (tensor)   : (total_cand_num, ), label mapped in the movie
+            - cast_offsets / cand_offsets (list) : the range of movie i is [offsets[i], offsets[i + 1])
+        '''
+        self.data_path = data_path
+        self.movies = sorted(os.listdir(data_path))
+        self.device = device
+
+        cast_features, cand_features, cand_labels = [], [], []
+        self.cast_offsets, self.cand_offsets = [0], [0]
+
+        for mov in self.movies:
+            cast = np.load(os.path.join(data_path, mov, 'cast', 'features.npy'))
+            cand = np.load(os.path.join(data_path, mov, 'candidates', 'features.npy'))
+            labels = np.load(os.path.join(data_path, mov, 'candidates', 'labels.npy'))
+
+            if drop_others:
+                keep = labels < cast.shape[0]
+                cand, labels = cand[keep], labels[keep]
+
+            cast_features.append(torch.from_numpy(cast))
+            cand_features.append(torch.from_numpy(cand))
+            cand_labels.append(torch.from_numpy(labels).long())
+            self.cast_offsets.append(self.cast_offsets[-1] + cast.shape[0])
+            self.cand_offsets.append(self.cand_offsets[-1] + cand.shape[0])
+
+        self.cast_features = torch.cat(cast_features, dim=0).float().to(device)
+        self.cand_features = torch.cat(cand_features, dim=0).float().to(device)
+        self.cand_labels   = torch.cat(cand_labels, dim=0).to(device)
+
+    def __len__(self):
+        return len(self.movies)
+
+    def num_candidates(self, index):
+        return self.cand_offsets[index + 1] - self.cand_offsets[index]
+
+    def casts(self, index):
+        '''
+          Return:
+          - features (tensor) : (num_cast, 2048)
+          - labels (tensor)   : (num_cast, ), 0 ~ num_cast - 1
+        '''
+        start, end = self.cast_offsets[index], self.cast_offsets[index + 1]
+        return self.cast_features[start:end], torch.arange(end - start, device=self.device)
+
+    def sample(self, index, batchsize):
+        '''
+          Return a batch of random candidates of movie[index], by tensor indexing.
+
+          Return:
+          - features (tensor) : (batchsize, 2048)
+          - labels (tensor)   : (batchsize, )
+        '''
+        start, end = self.cand_offsets[index], self.cand_offsets[index + 1]
+        indices = torch.randint(start, end, size=(batchsize, ), device=self.device)
+        return self.cand_features[indices], self.cand_labels[indices]
+
+def calibration_images(data_path, transform, num_images=512):
+    '''
+      Take the candidates of the movies in turn (movie 1 image 1, movie 2 image 1, ...,
+      movie 1 image 2, ...), until num_images images are collected.
+      Used to calibrate the quantized feature extractor.
+
+      Input:
+        - data_path = '~./IMDb_resize/train  (or val)
+
+      Return:
+        - images (torch.tensor) : (num_images, 3, height, width)
+    '''
+    dataset = CandDataset(data_path=data_path, drop_others=False, transform=transform, action='save')
+
+    paths = []
+    for mov in sorted(dataset.movies):
+        paths.append(list(dataset.all_candidates[mov]['index']))
+
+    images = []
+    for path in itertools.chain.from_iterable(itertools.zip_longest(*paths)):
+        if len(images) >= num_images:
+            break
+
+        if path is None:
+            continue
+
+        image = Image.open(os.path.join(dataset.root_path, path))
+        images.append(transform(image) if transform else image)
+
+    return torch.stack(images, dim=0)
+
 def dataloader_unittest(debug=False):
 
     ########################################################
@@ -5,8 +5,9 @@
   Synopsis     [ To inference trained model with testing images, output csv file ]
 
   Example:
-  - python3 inference_csv.py --action test --dataroot ./IMDb_resize/ --model ./net_best.pth --out_csv ./result/ --save_feature
-  >> 
+  - python3 inference_csv.py --action test --dataroot ./IMDb_resize/ --model ./net_best.pth --out_csv ./result/ --feature_cache ./cache/
+  >> The features are cached by (checkpoint hash, transform config, image path),
+     the next inference with the same checkpoints skips the backbone.
 
   - python3 inference_csv.py --action val --dataroot ./IMDb_resize/ --model ./net_best.pth --out_csv ./result/
   >> 
@@ -17,8 +18,13 @@
 
   - python3.7 inference_csv.py --dataroot ./IMDb_resize/ --model_features ./model_face_4096/resnet50_032.pth --model_classifier ./model_face_4096/classifier_032.pth --out_csv ./validation/ --out_dim 4096 --action val rerank --k1 20 40 --k2 6 10 --lambda_value 0.15
   >>
+
+  # Export feature_extractor + classifier as one TorchScript module, then inference with it
+  - python3.7 inference_csv.py --model_features ./models/resnet50.pth --model_classifier ./models/classifier.pth --out_dim 2048 export --script_path ./models/pipeline.pt
+  - python3.7 inference_csv.py --model_script ./models/pipeline.pt --out_dim 2048 --action val
 """
 import argparse
+import concurrent.futures
 import csv
 import itertools
 import os
@@ -26,217 +32,326 @@ import sys
 
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 import torchvision.transforms as transforms
 from torch import nn
 from torch.optim import lr_scheduler
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 
 import evaluate
 import evaluate_rerank
 import final_eval
 import utils
-from imdb import CandDataset, CastDataset
+from extraction import PipelinedExtractor, TestTimeAugmentation, compose, extract, extract_loader, prepare
+from feature_cache import FeatureCache, file_hash
+from imdb import CandDataset, CastDataset, calibration_images
 from model_res50 import (Classifier, FeatureExtractorFace,
-                         FeatureExtractorOrigin)
+                         FeatureExtractorOrigin, FeatureExtractorQuantized,
+                         Identity, export_pipeline, load_pipeline)
 
 newline = '' if sys.platform.startswith('win') else '\n'
 
+def extract_cached(keys: list, extract_missing, cache: FeatureCache) -> torch.Tensor:
+    '''
+      Get the features from the cache, only the missing ones are extracted.
+
+      Params:
+      - keys: the image paths
+      - extract_missing: function, extract_missing(indices) returns the features of keys[indices]
+
+      Return:
+      - features: Tensor _len(keys) x dim, on CPU
+    '''
+    features, misses = cache.get(keys)
+
+    if len(misses) > 0:
+        out = extract_missing(misses)
+        cache.put([keys[i] for i in misses], out)
+
+        for i, feature in zip(misses, out):
+            features[i] = feature
+
+    return torch.stack(features, dim=0)
+
+def movie_features(model, cast, cast_names, moviename, cand_data, candloader: DataLoader, 
+                   opt, device, engine=None, cache=None):
+    '''
+      Extract the features of the casts and the candidates of the movie.
+
+      Params:
+      - cast: Tensor _1 x num_cast x 3 x H x W
+      - cache: FeatureCache, if given, only the images not in the cache are extracted
+
+      Return:
+      - casts_features, cast_names, candidates_features, cand_names
+    '''
+    cast_names = [x[0] for x in cast_names]
+
+    if opt.action == 'val':
+        cand_data.set_mov_name_val(moviename)
+        cand_data.mv = moviename
+
+    if opt.action == 'test':
+        cand_data.set_mov_name_test(moviename)
+
+    cand_names = cand_data.image_names()
+
+    if cache is None:
+        cast_out = extract(model, cast.squeeze(0), device)     # cast.size[1, num_cast, 3, 224, 224]
+        cand_out, _ = extract_loader(model, candloader, device, engine=engine)   # cand_size = bs, 3, w, c
+
+    else:
+        cast_keys = ['{}/{}/cast/{}'.format(opt.action, moviename, name) for name in cast_names]
+        cand_keys = ['{}/{}/candidates/{}'.format(opt.action, moviename, name) for name in cand_names]
+
+        cast_out = extract_cached(cast_keys, lambda misses: extract(model, cast.squeeze(0)[misses], device), cache)
+        cand_out = extract_cached(cand_keys, lambda misses: extract_loader(model, 
+            DataLoader(Subset(cand_data, misses), batch_size=candloader.batch_size, num_workers=candloader.num_workers,
+                       pin_memory=candloader.pin_memory), 
+            device, engine=engine)[0], cache)
+
+    print('[Testing] {} processed ... cast: {}, candidates: {}'.format(moviename, cast_out.size()[0], cand_out.size()[0]))
+
+    cast_names = np.asarray(cast_names, dtype=object)
+    cand_names = np.asarray(cand_names, dtype=object)
+
+    return cast_out.to(device), cast_names, cand_out.to(device), cand_names
+
+def extract_features(castloader: DataLoader, candloader: DataLoader, cand_data, 
+                     feature_extractor: nn.Module, classifier: nn.Module, 
+                     opt, device, engine=None, cache=None) -> list:
+    '''
+      Extract the features of all the movies.
+
+      Return:
+      - features: [(casts_features, cast_names, candidates_features, cand_names), ...], one tuple per movie
+    '''
+    model = prepare(compose(feature_extractor, classifier))
+
+    # Flipped (and rescaled) views are run in the same batch as the original images
+    if opt.tta:
+        model = TestTimeAugmentation(model, flip=True, scales=opt.tta_scales)
+
+    features = []
+
+    for i, batch in enumerate(castloader, 1):
+        print("[{:3d}/{:3d}]".format(i, len(castloader)))
+
+        # val : (cast, labels, moviename, cast_names)
+        # test: (cast, moviename, cast_names)
+        cast, moviename, cast_names = batch[0], batch[-2][0], batch[-1]
+
+        features.append(movie_features(
+            model, cast, cast_names, moviename, cand_data, candloader, opt, device, engine=engine, cache=cache))
+
+    if cache is not None:
+        print(cache.summary())
+
+    return features
+
+def cosine_results(features: list, mute=False) -> list:
+    ''' Rank the candidates of each movie by cosine similarity '''
+    results = []
+
+    for casts_features, cast_names, candidates_features, cand_names in features:
+        results.extend(evaluate.cosine_similarity(casts_features, cast_names, candidates_features, cand_names, mute=mute))
+
+    return results
+
+def rerank_results(features: list, k1=20, k2=6, lambda_value=0.3) -> list:
+    ''' Rank the candidates of each movie by re-ranking '''
+    results = []
+
+    for casts_features, cast_names, candidates_features, cand_names in features:
+        results.extend(evaluate_rerank.predict_1_movie(casts_features, cast_names, candidates_features, cand_names, 
+                                                       k1=k1, k2=k2, lambda_value=lambda_value))
+
+    return results
+
+def write_results(results: list, path, opt, mute=False) -> float:
+    '''
+      Write the submission csv.
+
+      Return:
+      - mAP if action == 'val'
+      - mAP is 0 for action == 'test'
+    '''
+    mAP = 0
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    with open(path, 'w', newline=newline) as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=['Id', 'Rank'])
+        writer.writeheader()
+        for r in results:
+            writer.writerow(r)
+
+    print('Testing output "{}" writed. \n'.format(path))
+
+    if opt.action == 'val':
+        mAP, AP_dict = final_eval.eval(path, os.path.join(opt.dataroot, "val_GT.json"))
+        
+        if not mute:
+            for key, val in AP_dict.items():
+                record = 'AP({}): {:.2%}'.format(key, val)
+                print(record)    
+        
+        print('[ mAP = {:.2%} ]\n'.format(mAP))
+
+    return mAP
+
 def test(castloader: DataLoader, candloader: DataLoader, cast_data, cand_data, 
          feature_extractor: nn.Module, classifier: nn.Module, 
-         opt, device, feature_dim=1024, k1=20, k2=6, lambda_value=0.3, mute=False) -> list:
+         opt, device, feature_dim=1024, k1=20, k2=6, lambda_value=0.3, mute=False, engine=None, cache=None) -> list:
     '''
       Inference by trained model, generated inferenced result if needed.
 
+      Params:
+      - engine: PipelinedExtractor to load the candidates, use the candloader if None
+      - cache: FeatureCache of the outputs of the model, see build_cache()
+
       Return: 
-      - mAP if action == 'val'
+      - [cosine mAP, rerank mAP] if action == 'val'
       - mAP is 0 for action == 'test'
     '''
     print('Start Inferencing {} dataset ... '.format(opt.action))    
 
-    classifier.eval()
-    if feature_extractor is not None:
-        feature_extractor.eval()
-    
-    # Constant setting
-    mAP = 0
-    results_cosine = []
-    results_rerank = []
+    features = extract_features(castloader, candloader, cand_data, feature_extractor, classifier, 
+                                opt, device, engine=engine, cache=cache)
+
+    results_cosine = cosine_results(features, mute=mute)
+    results_rerank = rerank_results(features, k1=k1, k2=k2, lambda_value=lambda_value)
 
-    # --------------------------------- # 
-    # If ground truth exists            # 
-    # --------------------------------- #
-    if opt.action == 'val':
-        for i, (cast, labels, moviename, cast_names) in enumerate(castloader, 1):
-            print("[{:3d}/{:3d}]".format(i, len(castloader)))
-
-            moviename = moviename[0]
-
-            cast = cast.to(device) # cast_size = 1, num_cast + 1, 3, 448, 448
-            cast_out = feature_extractor(cast.squeeze(0))
-            cast_out = classifier(cast_out)
-            cast_out = cast_out.detach().cpu().view(-1, feature_dim)
-            cast_names = [x[0] for x in cast_names]
-            
-            cand_data.set_mov_name_val(moviename)
-            cand_data.mv = moviename
-
-            cand_out = torch.tensor([])
-            cand_names = []
-            for j, (cand, _, cand_name) in enumerate(candloader):
-                cand = cand.to(device)  # cand_size = bs, 3, w, c
-                
-                if feature_extractor is not None:
-                    out = feature_extractor(cand)
-                    out = classifier(out)
-                else:
-                    out = classifier(cand)
-
-                out = out.detach().cpu().view(-1, feature_dim)
-                cand_out  = torch.cat((cand_out, out), dim=0)
-                cand_names.extend(cand_name)   
-        
-            casts_features = cast_out.to(device)
-            candidates_features = cand_out.to(device)
-
-            print('[Testing]', moviename, 'processed ...', cand_out.size()[0])
-            
-            cast_names = np.asarray(cast_names, dtype=object)
-            cand_names = np.asarray(cand_names, dtype=object)
-
-            result = evaluate.cosine_similarity(casts_features, cast_names, candidates_features, cand_names, mute=mute)
-            results_cosine.extend(result)
-            
-            result = evaluate_rerank.predict_1_movie(casts_features, cast_names, candidates_features, cand_names, 
-                                        k1=k1, k2=k2, lambda_value=lambda_value)
-            results_rerank.extend(result)
-
-    # --------------------------------- # 
-    # If ground truth doesn't exists    # 
-    # --------------------------------- #
-    if opt.action == 'test':
-        for i, (cast, moviename, cast_names) in enumerate(castloader, 1):
-            print("[{:3d}/{:3d}]".format(i, len(castloader)))
-
-            moviename = moviename[0]    # unpacked from batch
-
-            cast_names = [x[0] for x in cast_names]
-
-            if not opt.load_feature:
-                print("generating {}'s cast features".format(moviename))
-
-                cast = cast.to(device)          # cast.size[1, num_cast, 3, 224, 224]
-                cast_out = feature_extractor(cast.squeeze(0))
-                cast_out = classifier(cast_out)
-                cast_out = cast_out.detach().cpu().view(-1, feature_dim)
-
-                casts_features = cast_out.to(device)
-
-                print("generating {}'s candidate features".format(moviename))
-                
-                cand_data.set_mov_name_test(moviename)
-                cand_out = torch.tensor([])
-                cand_names = []
-                for j, (cand, cand_name) in enumerate(candloader):
-                    cand_names.extend(cand_name)
-                    
-                    cand = cand.to(device)
-                    out = feature_extractor(cand)
-                    out = classifier(out)
-                    
-                    out = out.detach().cpu().view(-1, feature_dim)
-                    
-                    cand_out = torch.cat((cand_out, out), dim=0)
-
-                candidates_features = cand_out.to(device)
-
-                cast_names = np.asarray(cast_names, dtype=object)
-                cand_names = np.asarray(cand_names, dtype=object)
-
-                # Save cast features 
-                if opt.save_feature:
-                    feature_path = './inference/test/{}/cast/'.format(moviename)
-                    os.makedirs(feature_path, exist_ok=True)
-                    np.save(os.path.join(feature_path, "features.npy"), casts_features)
-                    np.save(os.path.join(feature_path, "names.npy"), cast_names)
-
-                # Save candidates features
-                if opt.save_feature:
-                    feature_path = './inference/test/{}/candidates/'.format(moviename)
-                    os.makedirs(feature_path, exist_ok=True)
-                    np.save(os.path.join(feature_path, "features.npy"), candidates_features)
-                    np.save(os.path.join(feature_path, "names.npy"), cand_names)
-
-                print('imgs_num({}) / file_names({})'.format(cand_out.size()[0], len(cand_names)))
-            
-            else:   # if load_feature:
-                print("loading {}'s cast features".format(moviename))
-                feature_path = './inference/test/{}/cast/features.npy'.format(moviename)
-                names_path = './inference/test/{}/cast/names.npy'.format(moviename)
-                casts_features = np.load(feature_path)
-                cast_names     = np.load(names_path)
-
-                print("loading {}'s candidate features".format(moviename))
-                feature_path = './inference/test/{}/candidates/features.npy'.format(movienmae)
-                names_path = './inference/test/{}/candidates/names.npy'.format(moviename)
-                candidates_features = np.load(feature_path)
-                cand_names          = np.load(names_path)
-
-                print('file_names({})'.format(len(cand_names)))
-
-            print('[Testing] {} processing predict_ranking ... \n'.format(moviename))
-            
-            # predict_ranking
-            result = evaluate.cosine_similarity(casts_features, cast_names, candidates_features, cand_names, mute=mute)
-            results_cosine.extend(result)
-            result = evaluate_rerank.predict_1_movie(casts_features, cast_names, candidates_features, cand_names,
-                                        k1=k1, k2=k2, lambda_value=lambda_value)
-            results_rerank.extend(result)
-    
     mAPs = []
     for submission, results in (('cosine.csv', results_cosine), ('rerank.csv', results_rerank)):
-        os.makedirs(opt.out_folder, exist_ok=True)
-        path = os.path.join(opt.out_folder, submission)
-    
-        with open(path, 'w', newline=newline) as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=['Id', 'Rank'])
-            writer.writeheader()
-            for r in results:
-                writer.writerow(r)
-
-        print('Testing output "{}" writed. \n'.format(path))
-
-        if opt.action == 'val':
-            mAP, AP_dict = final_eval.eval(path, os.path.join(opt.dataroot, "val_GT.json"))
-            
-            if not mute:
-                for key, val in AP_dict.items():
-                    record = 'AP({}): {:.2%}'.format(key, val)
-                    print(record)    
-            
-            print('[ mAP = {:.2%} ]\n'.format(mAP))
-
-        mAPs.append(mAP)
+        mAPs.append(write_results(results, os.path.join(opt.out_folder, submission), opt, mute=mute))
+
+    return mAPs
+
+# The features of the sweep, sent once to each worker process by sweep_worker_init()
+_sweep_features = None
+
+def sweep_worker_init(num_threads, features):
+    global _sweep_features
+
+    torch.set_num_threads(num_threads)
+    _sweep_features = features
+
+def sweep_worker(k1, k2, value) -> list:
+    ''' rerank_results() of one config on the features of the worker '''
+    return rerank_results(_sweep_features, k1, k2, value)
+
+def sweep(features: list, configs: list, opt, workers=1) -> list:
+    '''
+      Evaluate the re-ranking configs on the same features, the configs are
+      distributed to the worker processes if workers > 1. The features are
+      sent once to each worker, only the configs are sent per task.
+
+      Return:
+      - mAPs: rerank mAP of each config
+    '''
+    if workers > 1:
+        # The features are pickled to the workers, keep them on CPU
+        features = [(cast.cpu(), cast_names, cand.cpu(), cand_names) for cast, cast_names, cand, cand_names in features]
+
+        context = mp.get_context('spawn')
+        num_threads = max(torch.get_num_threads() // workers, 1)
+
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=sweep_worker_init, 
+                                                    initargs=(num_threads, features)) as executor:
+            results = list(executor.map(sweep_worker, *zip(*configs)))
+    else:
+        results = [rerank_results(features, k1, k2, value) for k1, k2, value in configs]
+
+    mAPs = []
+    for (k1, k2, value), result in zip(configs, results):
+        path = os.path.join(opt.out_folder, 'rerank_k1_{}_k2_{}_lambda_{}.csv'.format(k1, k2, value))
+        mAPs.append(write_results(result, path, opt, mute=True))
 
     return mAPs
 
+def build_models(opt, device, transform) -> (nn.Module, nn.Module):
+    '''
+      Build the feature_extractor and the classifier with the trained parameters.
+      If opt.model_script is given, the exported pipeline is returned as the
+      feature_extractor, and the classifier is an Identity.
+
+      Return:
+      - feature_extractor
+      - classifier
+    '''
+    if opt.model_script:
+        print("Pipeline read: {}".format(opt.model_script))
+        return load_pipeline(opt.model_script, device), Identity()
+
+    feature_extractor = FeatureExtractorFace(precision=opt.precision)
+    classifier = Classifier(fc_in_features=2048, fc_out=opt.out_dim)
+    
+    if opt.model_features:
+        print("Parameter read: {}".format(opt.model_features))
+        feature_extractor = utils.load_network(feature_extractor, opt.model_features)
+
+    if opt.model_classifier:
+        print("Parameter read: {}".format(opt.model_classifier))
+        classifier = utils.load_network(classifier, opt.model_classifier)
+
+    if opt.quantize:
+        print("Quantizing the feature extractor with {} train images".format(opt.calibration_size))
+        images = calibration_images(os.path.join(opt.dataroot, 'train'), transform, opt.calibration_size)
+        feature_extractor = FeatureExtractorQuantized(feature_extractor, images)
+
+    return feature_extractor.to(device), classifier.to(device)
+
+def build_cache(opt, transform) -> FeatureCache:
+    '''
+      The features are keyed by the image path, in the namespace of everything
+      else which changes them: the content hash of the checkpoints, the transform
+      and the model options. Changing the checkpoint invalidates the cache.
+    '''
+    if opt.model_script:
+        checkpoints = [opt.model_script]
+    elif opt.model_classifier:
+        checkpoints = [opt.model_features or 'pretrain/resnet50_ft_weight.pkl', opt.model_classifier]
+    else:
+        raise ValueError('--feature_cache needs --model_classifier or --model_script (the classifier is random initialized)')
+
+    namespace = '|'.join([
+        'checkpoints: ' + ','.join(file_hash(path) for path in checkpoints),
+        'transform: ' + repr(transform),
+        'dataroot: ' + os.path.abspath(opt.dataroot),
+        'precision: ' + opt.precision,
+        'quantize: {} ({})'.format(opt.quantize, opt.calibration_size if opt.quantize else 0),
+        'tta: {} ({})'.format(opt.tta, opt.tta_scales if opt.tta else []),
+    ])
+
+    # max_items=0: all the features are written to disk
+    return FeatureCache(namespace, spill_dir=opt.feature_cache, max_items=0)
+
 def main(opt):
     os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpu
-    device = torch.device("cuda")
+    device = torch.device('cpu') if opt.quantize else utils.selectDevice()
+
+    # The test transform, also of the calibration images of --quantize
+    transform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+
+    if opt.command == 'export':
+        feature_extractor, classifier = build_models(opt, torch.device('cpu'), transform)
+        
+        pipeline = export_pipeline(feature_extractor, classifier, normalize=opt.normalize)
+        os.makedirs(os.path.dirname(os.path.abspath(opt.script_path)), exist_ok=True)
+        torch.jit.save(pipeline, opt.script_path)
+        print('Pipeline exported to "{}"'.format(opt.script_path))
+
+        return
 
     folder_name = opt.action
 
     # ------------------------- # 
     # Dataset initialize        # 
     # ------------------------- #
-    if opt.load_feature:
-        transform = transforms.ToTensor()
-
-    if not opt.load_feature:
-        transform = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
-
     # Candidate Dataset and DataLOader
     test_data = CandDataset(
         data_path=os.path.join(opt.dataroot, folder_name),
@@ -252,25 +367,21 @@ def main(opt):
         action=opt.action
     )
 
-    test_cand = DataLoader(test_data, batch_size=opt.batchsize, shuffle=False, num_workers=opt.num_workers)
-    test_cast = DataLoader(test_cast_data, batch_size=1, shuffle=False, num_workers=opt.num_workers)
+    test_cand = DataLoader(test_data, batch_size=opt.batchsize, shuffle=False, num_workers=opt.num_workers,
+                           pin_memory=torch.cuda.is_available())
+    test_cast = DataLoader(test_cast_data, batch_size=1, shuffle=False, num_workers=opt.num_workers,
+                           pin_memory=torch.cuda.is_available())
     
     print(opt)
 
+    engine = PipelinedExtractor(opt.decode_threads, opt.prefetch) if opt.decode_threads > 0 else None
+    cache = build_cache(opt, transform) if opt.feature_cache else None
+
     if not opt.command: # Default validation / inference 
         # ------------------------- # 
         # Model initialize          # 
         # ------------------------- #
-        feature_extractor = FeatureExtractorFace()# .to(device)
-        classifier = Classifier(fc_in_features=2048, fc_out=opt.out_dim)# .to(device)
-        
-        if opt.model_features:
-            print("Parameter read: {}".format(opt.model_features))
-            feature_extractor = utils.load_network(feature_extractor, opt.model_features).to(device)
-
-        if opt.model_classifier:
-            print("Parameter read: {}".format(opt.model_classifier))
-            classifier = utils.load_network(classifier, opt.model_classifier).to(device).to(device)
+        feature_extractor, classifier = build_models(opt, device, transform)
 
         # ------------------------- # 
         # Execute Test Function     # 
@@ -278,43 +389,34 @@ def main(opt):
         with torch.no_grad():
             test(test_cast, test_cand, test_cast_data, test_data, 
                 feature_extractor, classifier, opt, device, 
-                k1=40, k2=6, lambda_value=0.1, feature_dim=opt.out_dim, mute=False)
+                k1=40, k2=6, lambda_value=0.1, feature_dim=opt.out_dim, mute=False, engine=engine, cache=cache)
+
+        if engine is not None:
+            print(engine.summary())
         
         return
     
     if opt.command == 'rerank':
-        max_length = max([len(opt.k1), len(opt.k2), len(opt.lambda_value)])
-        
-        configs = itertools.product(opt.k1, opt.k2, opt.lambda_value)
-        feature_extractor = FeatureExtractorFace().to(device)
-        classifier = Classifier(fc_in_features=2048, fc_out=opt.out_dim).to(device)
-        
-        if opt.model_features:
-            print("Parameter read: {}".format(opt.model_features))
-            feature_extractor = utils.load_network(feature_extractor.cpu(), opt.model_features).to(device)
-
-        if opt.model_classifier:
-            print("Parameter read: {}".format(opt.model_classifier))
-            classifier = utils.load_network(classifier.cpu(), opt.model_classifier).to(device).to(device)
+        configs = list(itertools.product(opt.k1, opt.k2, opt.lambda_value))
+        workers = opt.workers if opt.workers > 0 else min(len(configs), os.cpu_count())
+        feature_extractor, classifier = build_models(opt, device, transform)
 
         # ------------------------- # 
-        # Execute Test Function     # 
+        # Extract once, then sweep  # 
         # ------------------------- #
-        history = []
+        with torch.no_grad():
+            features = extract_features(test_cast, test_cand, test_data, feature_extractor, classifier, 
+                                        opt, device, engine=engine, cache=cache)
 
-        for k1, k2, value in configs:
-            print("[k1: {:3d}, k2: {:3d}, lambda_value: {:.4f}]".format(k1, k2, value))
-        
-            with torch.no_grad():
-                mAPs = test(test_cast, test_cand, test_cast_data, test_data, 
-                    feature_extractor, classifier, opt, device, 
-                    k1=k1, k2=k2, lambda_value=value, feature_dim=opt.out_dim, mute=True)
-                
-            history.append(mAPs)
+        cosine_mAP = write_results(cosine_results(features, mute=True), os.path.join(opt.out_folder, 'cosine.csv'), opt, mute=True)
+        history = sweep(features, configs, opt, workers=workers)
+
+        print("[Cosine] mAP: {:.4f}".format(cosine_mAP))
+        for (k1, k2, value), mAP in zip(configs, history):
+            print("[k1: {:3d}, k2: {:3d}, lambda_value: {:.4f}] [Rerank] mAP: {:.4f}".format(k1, k2, value, mAP))
 
-        for (k1, k2, value), history in zip(configs, history):
-            print("[k1: {:3d}, k2: {:3d}, lambda_value: {:.4f}] [Cosine] mAP: {:.4f}".format(k1, k2, value, history[0]))
-            print("[k1: {:3d}, k2: {:3d}, lambda_value: {:.4f}] [Rerank] mAP: {:.4f}".format(k1, k2, value, history[1]))
+        if engine is not None:
+            print(engine.summary())
 
         return
 
@@ -328,16 +430,23 @@ if __name__ == '__main__':
     # I/O Setting (important !!!)
     parser.add_argument('--model_features', help='model checkpoint path to extract features')    # ./model_face/net_best.pth
     parser.add_argument('--model_classifier', help='model checkpoint path to classifier')
+    parser.add_argument('--model_script', help='TorchScript pipeline exported by the export command, replace --model_features and --model_classifier')
     parser.add_argument('--dataroot', default='./IMDb_resize/', type=str, help='Directory of dataroot')
     parser.add_argument('--action', default='test', type=str, help='action type (test / val)')
     parser.add_argument('--out_dim', default=1024, type=int, help='to set the output dimensions of FC Layer')
     parser.add_argument('--gt', type=str, help='if gt_file is exists, measure the mAP.')
     parser.add_argument('--out_folder',  default='./inference/', help='output csv folder name')
-    parser.add_argument('--save_feature', action='store_true', help='save new np features when processing')
-    parser.add_argument('--load_feature', action='store_true', help='load old np features when processing')
+    parser.add_argument('--feature_cache', help='folder of the feature cache, keyed by (checkpoint hash, transform, image path)')
+    parser.add_argument('--tta', action='store_true', help='test-time augmentation, sum the embeddings of the original and flipped images')
+    parser.add_argument('--tta_scales', default=[1.0], nargs='*', type=float, help='scaling factors of the test-time augmentation (with --tta)')
     # Device Setting
     parser.add_argument('--gpu', default='0', type=str, help='')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'], help='precision of the feature extractor forward')
+    parser.add_argument('--quantize', action='store_true', help='static int8 quantized feature extractor (CPU only)')
+    parser.add_argument('--calibration_size', default=512, type=int, help='number of train images to calibrate the quantized feature extractor')
     parser.add_argument('--num_workers', default=0, type=int, help='')
+    parser.add_argument('--decode_threads', default=0, type=int, help='load the candidates by a pipelined extractor with N decode threads (0: by the DataLoader)')
+    parser.add_argument('--prefetch', default=4, type=int, help='maximum number of batches decoded ahead of the model (with --decode_threads)')
     
     # Rerank Setting
     subparser = parser.add_subparsers(dest='command', help='Advanced option')
@@ -345,6 +454,10 @@ if __name__ == '__main__':
     rerank_parser.add_argument('--k1', default=[20], nargs='*', type=int)
     rerank_parser.add_argument('--k2', default=[6], nargs='*', type=int)
     rerank_parser.add_argument('--lambda_value', default=[0.3], nargs='*', type=float)
+    rerank_parser.add_argument('--workers', default=0, type=int, help='number of processes to evaluate the configs (0: min(#configs, #cpu))')
+    export_parser = subparser.add_parser('export', help='export feature_extractor + classifier as one TorchScript module')
+    export_parser.add_argument('--script_path', default='./models/pipeline.pt', type=str, help='output path of the TorchScript module')
+    export_parser.add_argument('--normalize', action='store_true', help='L2 normalize the output features')
 
     opt = parser.parse_args()
     
@@ -360,9 +473,6 @@ if __name__ == '__main__':
     if not os.path.exists(opt.dataroot):
         raise IOError("{} is not exists".format(opt.dataroot))
     
-    if opt.save_feature and opt.load_feature:
-        raise ValueError('Cannot save and load features simultanesouly, please choose one of them')
-    
     # if not os.path.exists(opt.gt):
     #     pass
     #     raise IOError("{} is not exists".format(opt.gt))
@@ -7,12 +7,20 @@
   2. Feature_extractor_origin (Imagenet pretrained)
   3. Classifier --------->> fc_output  dropout
                             drop = 0 ->no dropout
+  4. FeatureExtractorQuantized (int8 FeatureExtractorFace / FeatureExtractorOrigin, CPU only)
+  5. FeaturePipeline ------>> feature_extractor + classifier (+ L2 normalize), see export_pipeline()
+
+  The feature extractors run in 'precision' ('fp32' / 'bf16' autocast),
+  and always output float32 features.
 """
+import os
 import pickle
 import torch
 import torch.nn as nn
 import torchvision
 
+import utils
+
 class Identity(nn.Module):
     def __init__(self):
         super(Identity, self).__init__()
@@ -20,10 +28,43 @@ class Identity(nn.Module):
     def forward(self, x):
         return x
 
+def load_pretrain_weights(model='pretrain/resnet50_ft_weight.pkl') -> dict:
+    """
+      Load the VGGFace2 pretrained weights.
+
+      The pickle is converted once to a native tensor checkpoint next to it
+      ('resnet50_ft_weight.pth'), which is loaded (memory-mapped if supported)
+      instead of the pickle when it is newer than the pickle.
+
+      Return:
+      - weights: the state dict of resnet50
+    """
+    checkpoint = model if model.endswith('.pth') else os.path.splitext(model)[0] + '.pth'
+
+    if os.path.exists(checkpoint) and (checkpoint == model or os.path.getmtime(checkpoint) >= os.path.getmtime(model)):
+        try:
+            return torch.load(checkpoint, map_location='cpu', mmap=True)
+        except TypeError:   # torch < 2.1: no mmap
+            return torch.load(checkpoint, map_location='cpu')
+
+    with open(model, 'rb') as f:
+        obj = f.read()
+    weights = {key: torch.from_numpy(arr) for key, arr in pickle.loads(obj, encoding='latin1').items()}
+
+    try:
+        torch.save(weights, checkpoint)
+        print('Converted {} to {}'.format(model, checkpoint))
+    except OSError as e:
+        print('Cannot save the converted weights to {}: {}'.format(checkpoint, e))
+
+    return weights
+
 class FeatureExtractorFace(nn.Module):
-    def __init__(self, fixed_params=True, model='pretrain/resnet50_ft_weight.pkl'):
+    def __init__(self, fixed_params=True, model='pretrain/resnet50_ft_weight.pkl', precision='fp32'):
         super(FeatureExtractorFace, self).__init__()
         
+        self.precision = precision
+
         # load pytorch resnet50
         resnet = torchvision.models.resnet50(num_classes=8631, pretrained=False)
 
@@ -32,11 +73,14 @@ class FeatureExtractorFace(nn.Module):
             for param in resnet.parameters():
                 param.requires_grad = False
         
-        # load pretrained weights
-        with open(model, 'rb') as f:
-            obj = f.read()
-        weights = {key: torch.from_numpy(arr) for key, arr in pickle.loads(obj, encoding='latin1').items()}
-        resnet.load_state_dict(weights, strict=False)
+        # load pretrained weights, report the keys skipped by strict=False
+        weights = load_pretrain_weights(model)
+        result = resnet.load_state_dict(weights, strict=False)
+
+        if result.missing_keys:
+            print('[FeatureExtractorFace] Missing keys in {}: {}'.format(model, result.missing_keys))
+        if result.unexpected_keys:
+            print('[FeatureExtractorFace] Unexpected keys in {}: {}'.format(model, result.unexpected_keys))
 
         # delete last FC layer
         resnet.fc = Identity()
@@ -45,13 +89,16 @@ class FeatureExtractorFace(nn.Module):
         self.resnet_layer = resnet
 
     def forward(self, input_data):        
-        feature = self.resnet_layer(input_data)
-        return feature
+        with utils.autocast(input_data.device, self.precision):
+            feature = self.resnet_layer(input_data)
+        return feature.float()
 
 class FeatureExtractorOrigin(nn.Module):
-    def __init__(self):
+    def __init__(self, precision='fp32'):
         super(FeatureExtractorOrigin, self).__init__()
 
+        self.precision = precision
+
         # load pytorch pretrained resnet50
         resnet = torchvision.models.resnet50(pretrained = True)
 
@@ -66,8 +113,49 @@ class FeatureExtractorOrigin(nn.Module):
         self.resnet_layer = resnet
 
     def forward(self, input_data):        
-        feature = self.resnet_layer(input_data)
-        return feature
+        with utils.autocast(input_data.device, self.precision):
+            feature = self.resnet_layer(input_data)
+        return feature.float()
+
+class FeatureExtractorQuantized(nn.Module):
+    def __init__(self, feature_extractor, calibration_images, batchsize=32, backend=None):
+        """
+          Post-training static int8 quantization of a feature extractor.
+
+          Params:
+          - feature_extractor: FeatureExtractorFace or FeatureExtractorOrigin (trained weights)
+          - calibration_images: Tensor _N x 3 x 224 x 224, to observe the activation ranges
+          - backend: quantized engine, default torch.backends.quantized.engine
+        """
+        super(FeatureExtractorQuantized, self).__init__()
+
+        backend = backend or torch.backends.quantized.engine
+        torch.backends.quantized.engine = backend
+
+        # same layers as torchvision resnet50, with quant / dequant stubs and fusable modules
+        resnet = torchvision.models.quantization.resnet50(num_classes=8631, quantize=False)
+        resnet.fc = Identity()
+        resnet.load_state_dict(feature_extractor.resnet_layer.state_dict())
+        resnet.eval()
+
+        # fuse conv-bn-relu
+        resnet.fuse_model()
+        resnet.qconfig = torch.quantization.get_default_qconfig(backend)
+        torch.quantization.prepare(resnet, inplace=True)
+
+        # calibration
+        with torch.no_grad():
+            for images in torch.split(calibration_images, batchsize):
+                resnet(images.cpu())
+
+        torch.quantization.convert(resnet, inplace=True)
+
+        # defined all resnet layers
+        self.resnet_layer = resnet
+
+    def forward(self, input_data):
+        feature = self.resnet_layer(input_data.cpu())
+        return feature.to(input_data.device)
 
 class Classifier(nn.Module):
     def __init__(self, fc_in_features=2048, fc_out=1024, drop=0.5, normalize=False):
@@ -90,6 +178,53 @@ class Classifier(nn.Module):
 
         return feature
 
+class FeaturePipeline(nn.Module):
+    def __init__(self, feature_extractor, classifier, normalize=False):
+        super(FeaturePipeline, self).__init__()
+
+        self.feature_extractor = feature_extractor
+        self.classifier = classifier
+        self.normalize = normalize
+
+    def forward(self, input_data):
+        feature = self.classifier(self.feature_extractor(input_data))
+
+        if self.normalize:
+            feature = nn.functional.normalize(feature, dim=1)
+
+        return feature
+
+def export_pipeline(feature_extractor, classifier, normalize=False, size=224):
+    """
+      Trace feature_extractor + classifier (+ L2 normalize) into one TorchScript module,
+      and freeze it (parameters become constants, BatchNorm folded into Conv / Linear).
+
+      Usage:
+      - torch.jit.save(export_pipeline(feature_extractor, classifier), path)
+      - pipeline = load_pipeline(path, device)
+
+      Return:
+      - pipeline: torch.jit.ScriptModule, images (N x 3 x H x W) to features (N x fc_out)
+    """
+    pipeline = FeaturePipeline(feature_extractor, classifier, normalize).cpu().eval()
+    example = torch.randn(2, 3, size, size)
+
+    with torch.no_grad():
+        pipeline = torch.jit.trace(pipeline, example)
+        pipeline = torch.jit.freeze(pipeline)
+
+    return pipeline
+
+def load_pipeline(path, device):
+    """
+      Load the pipeline exported by export_pipeline(), and optimize it for the device.
+      (The optimized graph can't be saved, so it is done when loading)
+    """
+    pipeline = torch.jit.load(path, map_location=device)
+    pipeline = torch.jit.optimize_for_inference(pipeline)
+
+    return pipeline
+
 def model_structure_unittest():
     """ Debug model structure """
     # img
@@ -1,7 +1,9 @@
 import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
 
-from matlab_cp2tform import get_similarity_transform_for_cv2
+from matlab_cp2tform import get_similarity_transform_for_cv2, get_similarity_transforms_for_cv2
 
 # reference facial points, a list of coordinates (x,y)
 REFERENCE_FACIAL_POINTS = [        # default reference facial points for crop_size = (112, 112); should adjust REFERENCE_FACIAL_POINTS accordingly for other crop_size
@@ -294,3 +296,88 @@ def warp_and_crop_face(src_img,
     face_img = cv2.warpAffine(src_img, tfm, (crop_size[0], crop_size[1]))
 
     return face_img
+
+
+def warp_and_crop_faces(src_imgs,
+                        facial_pts,
+                        reference_pts = None,
+                        crop_size=(96, 112)):
+    """
+    Function:
+    ----------
+        Batched warp_and_crop_face() with similarity transforms: the transforms
+        of all faces are solved at once, and all faces are warped by one
+        bilinear grid_sample() (zero border, as cv2.warpAffine())
+    Parameters:
+    ----------
+        @src_imgs: a list of N HxWxC np.array (uint8)
+            input image of each face, the same image could be repeated
+        @facial_pts: NxKx2 np.array
+            facial points of each face, each row is a pair of coordinates (x, y)
+        @reference_pts: Kx2 np.array, or None
+            if None, use default reference facial points
+        @crop_size: (w, h)
+            output face image size
+    Returns:
+    ----------
+        @face_imgs: Nxhxwx C np.array (uint8), h, w = crop_size[1], crop_size[0]
+    """
+
+    if reference_pts is None:
+        if crop_size[0] == 96 and crop_size[1] == 112:
+            reference_pts = REFERENCE_FACIAL_POINTS
+        else:
+            reference_pts = get_reference_facial_points(crop_size, 0, (0, 0), False)
+
+    ref_pts = np.float32(reference_pts)
+    src_pts = np.float32(facial_pts)
+
+    if src_pts.ndim != 3 or src_pts.shape[1:] != ref_pts.shape:
+        raise FaceWarpException(
+            'facial_pts.shape must be (N,K,2) with the same K as reference_pts')
+
+    num_faces = len(src_imgs)
+    if num_faces == 0:
+        return np.zeros((0, crop_size[1], crop_size[0], 3), np.uint8)
+
+    # cv2 matrices map the source to the crop, the grid needs the inverse
+    tfm = get_similarity_transforms_for_cv2(src_pts, ref_pts)
+    tfm = np.concatenate((tfm, np.tile([[[0, 0, 1]]], (num_faces, 1, 1))), axis=1)
+    tfm_inv = np.linalg.inv(tfm)
+
+    # only the source region of each face (with 1 pixel margin for the bilinear
+    # neighbours) is stacked, zero-padded to the largest one, as N x C x H x W
+    w, h = crop_size
+    corners = np.array([[0, 0, 1], [w - 1, 0, 1], [0, h - 1, 1], [w - 1, h - 1, 1]], np.float64)
+    corners = np.matmul(corners, tfm_inv[:, 0:2, :].transpose((0, 2, 1)))     # N x 4 x 2
+
+    lower = np.clip(np.floor(corners.min(axis=1)).astype(np.int64) - 1, 0, None)
+    upper = np.ceil(corners.max(axis=1)).astype(np.int64) + 2
+
+    regions = []
+    for i, img in enumerate(src_imgs):
+        (x0, y0), (x1, y1) = lower[i], upper[i]
+        x1, y1 = max(min(x1, img.shape[1]), x0), max(min(y1, img.shape[0]), y0)
+        regions.append(img[y0:y1, x0:x1])
+
+    height = max(max(region.shape[0] for region in regions), 2)
+    width = max(max(region.shape[1] for region in regions), 2)
+
+    imgs = torch.zeros((num_faces, src_imgs[0].shape[2], height, width))
+    for i, region in enumerate(regions):
+        imgs[i, :, 0:region.shape[0], 0:region.shape[1]] = torch.from_numpy(np.ascontiguousarray(region)).permute(2, 0, 1)
+
+    # theta: normalized crop coordinates -> normalized region coordinates (align_corners=True)
+    def normalize(w, h):
+        return np.array([[2 / (w - 1), 0, -1], [0, 2 / (h - 1), -1], [0, 0, 1]], np.float64)
+
+    shift = np.tile(np.eye(3), (num_faces, 1, 1))
+    shift[:, 0:2, 2] = -lower
+
+    theta = np.matmul(np.matmul(normalize(width, height), np.matmul(shift, tfm_inv)), np.linalg.inv(normalize(w, h)))
+    theta = torch.from_numpy(theta[:, 0:2, :].astype(np.float32))
+
+    grid = F.affine_grid(theta, (num_faces, imgs.shape[1], h, w), align_corners=True)
+    face_imgs = F.grid_sample(imgs, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+
+    return face_imgs.round_().clamp_(0, 255).byte().permute(0, 2, 3, 1).numpy()
@@ -2,23 +2,25 @@ import numpy as np
 import torch
 
 from box_utils import calibrate_box, convert_to_square, get_image_boxes, nms
-from first_stage import run_first_stage
+from first_stage import run_first_stage, run_first_stage_mosaic
 # from torch.autograd import Variable
 from get_nets import ONet, PNet, RNet
 
 pnet, rnet, onet = None, None, None
 
-def detect_faces(image, model_paths, min_face_size = 20.0, thresholds=[0.6, 0.7, 0.8], nms_thresholds=[0.7, 0.7, 0.7]) -> (np.ndarray, np.ndarray):
+# the output of an image without faces
+EMPTY = (np.zeros((0, 5), np.float32), np.zeros((0, 10), np.float32))
+
+def load_models(model_paths) -> (PNet, RNet, ONet):
     """
+    Load P-Net, R-Net and O-Net once, they are kept in the module-level globals
+    (i.e. once per process).
+
     Arguments:
-        image: an instance of PIL.Image.
-        min_face_size: a float number.
-        thresholds: a list of length 3.
-        nms_thresholds: a list of length 3.
+        model_paths: a list of length 3, paths of pnet.npy, rnet.npy and onet.npy.
 
     Returns:
-        two float numpy arrays of shapes [n_boxes, 4] and [n_boxes, 10],
-        bounding boxes and facial landmarks.
+        pnet, rnet, onet
     """
 
     global pnet, rnet, onet
@@ -37,10 +39,196 @@ def detect_faces(image, model_paths, min_face_size = 20.0, thresholds=[0.6, 0.7,
         onet.eval()
         print('ONet loaded')
 
-    # pnet = PNet(model_paths[0])
-    # rnet = RNet(model_paths[1])
-    # onet = ONet(model_paths[2])
-    # onet.eval()
+    return pnet, rnet, onet
+
+def detect_faces(image, model_paths, min_face_size = 20.0, thresholds=[0.6, 0.7, 0.8], nms_thresholds=[0.7, 0.7, 0.7], mosaic=False, max_faces=None, channels_last=False) -> (np.ndarray, np.ndarray):
+    """
+    Arguments:
+        image: an instance of PIL.Image.
+        min_face_size: a float number.
+        thresholds: a list of length 3.
+        nms_thresholds: a list of length 3.
+        mosaic: run P-Net once on the mosaic of the image pyramid,
+            otherwise once per scale (default, the mosaic is not faster on CPU yet).
+        max_faces: if given, stop at the coarsest scales where max_faces faces
+            are confirmed by O-Net (see detect_faces_batch).
+        channels_last: with max_faces, see detect_faces_batch.
+
+    Returns:
+        two float numpy arrays of shapes [n_boxes, 4] and [n_boxes, 10],
+        bounding boxes and facial landmarks.
+    """
+
+    if max_faces is not None:
+        return detect_faces_batch([image], model_paths, min_face_size, thresholds, nms_thresholds, mosaic, max_faces, channels_last)[0]
+
+    pnet, rnet, onet = load_models(model_paths)
+
+    with torch.no_grad():
+        # STAGE 1
+        scales = _pyramid_scales(image, min_face_size)
+        bounding_boxes = _first_stage(image, pnet, scales, thresholds[0], nms_thresholds[0], mosaic)
+        if bounding_boxes is None:
+            raise ValueError('No face is detected by P-Net')
+
+        # STAGE 2
+        img_boxes = torch.FloatTensor(get_image_boxes(bounding_boxes, image, size = 24))
+        output = [o.data.numpy() for o in rnet(img_boxes)]
+        bounding_boxes = _second_stage(bounding_boxes, output, thresholds[1], nms_thresholds[1])
+
+        # STAGE 3
+        img_boxes = get_image_boxes(bounding_boxes, image, size = 48)
+        if len(img_boxes) == 0: return [], []
+        output = [o.data.numpy() for o in onet(torch.FloatTensor(img_boxes))]
+
+        return _third_stage(bounding_boxes, output, thresholds[2], nms_thresholds[2])
+
+def detect_faces_batch(images, model_paths, min_face_size = 20.0, thresholds=[0.6, 0.7, 0.8], nms_thresholds=[0.7, 0.7, 0.7], mosaic=False, max_faces=None, channels_last=False) -> list:
+    """
+    Same as detect_faces() for each image, the stages are run for all the images
+    before the next one. With channels_last, the crops of all the images are
+    concatenated, R-Net and O-Net are run once per batch of images.
+
+    With max_faces, the scales are processed from coarse to fine, one scale of
+    each image at a time (P-Net, then R-Net and O-Net on the crops of all the
+    images). An image is done once O-Net confirms max_faces faces, its finer
+    scales are skipped. The faces of the coarser scales win, i.e. a larger face
+    is returned even if a smaller one has a higher score.
+
+    Arguments:
+        images: a list of PIL.Image.
+        max_faces: an integer, or None to run all the scales.
+        channels_last: run R-Net and O-Net once on the crops of all the images as
+            channels_last tensors, faster on CPU (max poolings), but the outputs are
+            not bitwise the same as detect_faces() and the crops of face_align.py
+            may differ by a few grey levels. By default, they are run image by image
+            on NCHW tensors, the same outputs as detect_faces().
+
+    Returns:
+        a list of (bounding boxes [n_boxes, 5], facial landmarks [n_boxes, 10]),
+        one for each image, empty arrays if no face is detected.
+    """
+
+    pnet, rnet, onet = load_models(model_paths)
+
+    with torch.no_grad():
+        if max_faces is not None:
+            return _detect_coarse_to_fine(images, pnet, rnet, onet, min_face_size, thresholds, nms_thresholds, max_faces, channels_last)
+
+        # STAGE 1, image by image
+        bounding_boxes = []
+        for image in images:
+            boxes = _first_stage(image, pnet, _pyramid_scales(image, min_face_size), thresholds[0], nms_thresholds[0], mosaic)
+            bounding_boxes.append(EMPTY[0] if boxes is None else boxes)
+
+        # STAGE 2 and 3
+        return _cascade(images, bounding_boxes, rnet, onet, thresholds, nms_thresholds, channels_last)
+
+def _detect_coarse_to_fine(images, pnet, rnet, onet, min_face_size, thresholds, nms_thresholds, max_faces, channels_last) -> list:
+    """
+    Early exit of detect_faces_batch(): all the stages are run scale by scale,
+    from the coarsest one, until max_faces faces are found in the image.
+    """
+
+    # in increasing order, i.e. the largest faces first
+    scales = [sorted(_pyramid_scales(image, min_face_size)) for image in images]
+    faces = [[] for _ in images]
+
+    active = [i for i in range(len(images)) if len(scales[i]) > 0]
+    level = 0
+
+    while len(active) > 0:
+        bounding_boxes = []
+        for i in active:
+            boxes = _first_stage(images[i], pnet, scales[i][level:(level + 1)], thresholds[0], nms_thresholds[0], mosaic = False)
+            bounding_boxes.append(EMPTY[0] if boxes is None else boxes)
+
+        outputs = _cascade([images[i] for i in active], bounding_boxes, rnet, onet, thresholds, nms_thresholds, channels_last)
+
+        for i, (boxes, landmarks) in zip(active, outputs):
+            if len(boxes) > 0:
+                faces[i].append((boxes, landmarks))
+
+        level += 1
+        active = [i for i in active if sum(len(boxes) for boxes, _ in faces[i]) < max_faces and level < len(scales[i])]
+
+    results = []
+    for found in faces:
+        if len(found) == 0:
+            results.append(EMPTY)
+            continue
+
+        # the same face may be found at several scales
+        bounding_boxes = np.vstack([boxes for boxes, _ in found])
+        landmarks = np.vstack([landmarks for _, landmarks in found])
+
+        keep = nms(bounding_boxes, nms_thresholds[2], mode = 'min')[:max_faces]
+        results.append((bounding_boxes[keep], landmarks[keep]))
+
+    return results
+
+def _cascade(images, bounding_boxes, rnet, onet, thresholds, nms_thresholds, channels_last=False) -> list:
+    """
+    R-Net and O-Net stages of the images, the crops of all the images are run in
+    one batch with channels_last (see _run_batch).
+
+    Arguments:
+        images: a list of PIL.Image.
+        bounding_boxes: a list of float numpy arrays of shape [n_boxes, 5], the outputs of _first_stage.
+        channels_last: see detect_faces_batch.
+
+    Returns:
+        a list of (bounding boxes [n_boxes, 5], facial landmarks [n_boxes, 10]).
+    """
+
+    # STAGE 2
+    img_boxes = [get_image_boxes(boxes, image, size = 24) for boxes, image in zip(bounding_boxes, images)]
+    outputs = _run_batch(rnet, img_boxes, channels_last)
+    bounding_boxes = [_second_stage(boxes, output, thresholds[1], nms_thresholds[1]) if len(boxes) > 0 else boxes
+                      for boxes, output in zip(bounding_boxes, outputs)]
+
+    # STAGE 3
+    img_boxes = [get_image_boxes(boxes, image, size = 48) for boxes, image in zip(bounding_boxes, images)]
+    outputs = _run_batch(onet, img_boxes, channels_last)
+
+    return [_third_stage(boxes, output, thresholds[2], nms_thresholds[2]) if len(boxes) > 0 else EMPTY
+            for boxes, output in zip(bounding_boxes, outputs)]
+
+def _run_batch(net, img_boxes, channels_last=False) -> list:
+    """
+    Run the net on the crops of the images: image by image on NCHW tensors
+    (the same outputs as detect_faces), or once on the crops of all the images
+    as a channels_last tensor.
+
+    Arguments:
+        img_boxes: a list of float numpy arrays of shape [n_i, 3, size, size].
+        channels_last: see detect_faces_batch.
+
+    Returns:
+        a list of the outputs of the net (numpy arrays) of each image.
+    """
+
+    # the outputs of a larger NCHW batch change slightly, and it is not faster
+    if not channels_last:
+        return [[o.data.numpy() for o in net(torch.FloatTensor(boxes))] if len(boxes) > 0 else None
+                for boxes in img_boxes]
+
+    counts = [len(boxes) for boxes in img_boxes]
+    if sum(counts) == 0:
+        return [None] * len(img_boxes)
+
+    # channels_last, the max poolings of NCHW tensors are much slower on CPU
+    img_boxes = torch.FloatTensor(np.concatenate(img_boxes)).contiguous(memory_format = torch.channels_last)
+    output = [o.data.numpy() for o in net(img_boxes)]
+
+    splits = np.cumsum(counts)[:-1]
+    return list(zip(*[np.split(o, splits) for o in output]))
+
+def _pyramid_scales(image, min_face_size) -> list:
+    """
+    Returns:
+        the scales of the image pyramid, in decreasing order.
+    """
 
     # BUILD AN IMAGE PYRAMID
     width, height = image.size
@@ -64,21 +252,36 @@ def detect_faces(image, model_paths, min_face_size = 20.0, thresholds=[0.6, 0.7,
         min_length *= factor
         factor_count += 1
 
-    # STAGE 1
+    return scales
+
+def _first_stage(image, pnet, scales, threshold, nms_threshold, mosaic):
+    """
+    Run P-Net on the image pyramid.
+
+    Returns:
+        a float numpy array of shape [n_boxes, 5], squared and calibrated
+        bounding boxes, or None if no box is found.
+    """
 
     # it will be returned
     bounding_boxes = []
 
     # run P-Net on different scales
-    for s in scales:
-        boxes = run_first_stage(image, pnet, scale = s, threshold = thresholds[0])
-        bounding_boxes.append(boxes)
+    if mosaic:
+        bounding_boxes = run_first_stage_mosaic(image, pnet, scales, threshold = threshold)
+    else:
+        for s in scales:
+            boxes = run_first_stage(image, pnet, scale = s, threshold = threshold)
+            bounding_boxes.append(boxes)
 
     # collect boxes (and offsets, and scores) from different scales
     bounding_boxes = [i for i in bounding_boxes if i is not None]
+    if len(bounding_boxes) == 0:
+        return None
+
     bounding_boxes = np.vstack(bounding_boxes)
 
-    keep = nms(bounding_boxes[:, 0:5], nms_thresholds[0])
+    keep = nms(bounding_boxes[:, 0:5], nms_threshold)
     bounding_boxes = bounding_boxes[keep]
 
     # use offsets predicted by pnet to transform bounding boxes
@@ -88,38 +291,46 @@ def detect_faces(image, model_paths, min_face_size = 20.0, thresholds=[0.6, 0.7,
     bounding_boxes = convert_to_square(bounding_boxes)
     bounding_boxes[:, 0:4] = np.round(bounding_boxes[:, 0:4])
 
-    # STAGE 2
+    return bounding_boxes
+
+def _second_stage(bounding_boxes, output, threshold, nms_threshold) -> np.ndarray:
+    """
+    Arguments:
+        bounding_boxes: a float numpy array of shape [n_boxes, 5].
+        output: offsets [n_boxes, 4] and probs [n_boxes, 2] of R-Net.
+
+    Returns:
+        a float numpy array of shape [n_boxes', 5].
+    """
 
-    img_boxes = get_image_boxes(bounding_boxes, image, size = 24)
-    img_boxes = torch.FloatTensor(img_boxes)
-    # img_boxes = Variable(torch.FloatTensor(img_boxes), volatile = True)
-    output = rnet(img_boxes)
-    offsets = output[0].data.numpy()  # shape [n_boxes, 4]
-    probs = output[1].data.numpy()  # shape [n_boxes, 2]
+    offsets, probs = output
 
-    keep = np.where(probs[:, 1] > thresholds[1])[0]
+    keep = np.where(probs[:, 1] > threshold)[0]
     bounding_boxes = bounding_boxes[keep]
     bounding_boxes[:, 4] = probs[keep, 1].reshape((-1, ))
     offsets = offsets[keep]
 
-    keep = nms(bounding_boxes, nms_thresholds[1])
+    keep = nms(bounding_boxes, nms_threshold)
     bounding_boxes = bounding_boxes[keep]
     bounding_boxes = calibrate_box(bounding_boxes, offsets[keep])
     bounding_boxes = convert_to_square(bounding_boxes)
     bounding_boxes[:, 0:4] = np.round(bounding_boxes[:, 0:4])
 
-    # STAGE 3
+    return bounding_boxes
+
+def _third_stage(bounding_boxes, output, threshold, nms_threshold) -> (np.ndarray, np.ndarray):
+    """
+    Arguments:
+        bounding_boxes: a float numpy array of shape [n_boxes, 5].
+        output: landmarks [n_boxes, 10], offsets [n_boxes, 4] and probs [n_boxes, 2] of O-Net.
+
+    Returns:
+        bounding boxes [n_boxes', 5] and facial landmarks [n_boxes', 10].
+    """
 
-    img_boxes = get_image_boxes(bounding_boxes, image, size = 48)
-    if len(img_boxes) == 0: return [], []
-    img_boxes = torch.FloatTensor(img_boxes)
-    # img_boxes = Variable(torch.FloatTensor(img_boxes), volatile = True)
-    output = onet(img_boxes)
-    landmarks = output[0].data.numpy()  # shape [n_boxes, 10]
-    offsets = output[1].data.numpy()  # shape [n_boxes, 4]
-    probs = output[2].data.numpy()  # shape [n_boxes, 2]
+    landmarks, offsets, probs = output
 
-    keep = np.where(probs[:, 1] > thresholds[2])[0]
+    keep = np.where(probs[:, 1] > threshold)[0]
     bounding_boxes = bounding_boxes[keep]
     bounding_boxes[:, 4] = probs[keep, 1].reshape((-1, ))
     offsets = offsets[keep]
@@ -133,7 +344,7 @@ def detect_faces(image, model_paths, min_face_size = 20.0, thresholds=[0.6, 0.7,
     landmarks[:, 5:10] = np.expand_dims(ymin, 1) + np.expand_dims(height, 1)*landmarks[:, 5:10]
 
     bounding_boxes = calibrate_box(bounding_boxes, offsets)
-    keep = nms(bounding_boxes, nms_thresholds[2], mode = 'min')
+    keep = nms(bounding_boxes, nms_threshold, mode = 'min')
     bounding_boxes = bounding_boxes[keep]
     landmarks = landmarks[keep]
 
@@ -0,0 +1,251 @@
+"""
+Benchmark of the MTCNN detector variants on CPU.
+
+Usage:
+    python detector_benchmark.py --source_root ./IMDb/val pyramid
+    >> images/s of detect_faces() with P-Net run once per scale (loop) and once
+       on the mosaic of the image pyramid (mosaic), and the deviation of the
+       boxes / landmarks against the first variant.
+
+    python detector_benchmark.py --source_root ./IMDb/val batch --batch_sizes 4 16
+    >> detect_faces() image by image against detect_faces_batch(), by default and
+       with channels_last (R-Net / O-Net run once on the crops of batch_size images).
+
+    python detector_benchmark.py --source_root ./IMDb/val early_exit
+    >> detect_faces_batch() with all the scales against max_faces=1 (coarse to fine,
+       stop at the first confirmed face), and the drift of the landmarks of the
+       first face (the one used by face_align.py).
+
+    python detector_benchmark.py --source_root ./IMDb/val nms
+    >> record the inputs of all the NMS calls of detect_faces(), check that the
+       pairwise (matrix) and the row by row suppression pick the same boxes, and time them.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+import box_utils
+import detector
+import first_stage
+from detector import detect_faces, detect_faces_batch
+from face_align import MODEL_PATHS
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def load_images(source_root, num_images) -> list:
+    """ The first num_images images (RGB) under source_root, in path order """
+    paths = []
+
+    for root, _, files in os.walk(source_root):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+
+    return [Image.open(path).convert('RGB') for path in sorted(paths)[:num_images]]
+
+def per_image(detect):
+    """ detect: image to (bounding boxes, landmarks), returns a function of the list of images """
+    def safe_detect(image):
+        # detect_faces() raises if no box survives a stage
+        try:
+            return detect(image)
+        except ValueError:
+            return np.zeros((0, 5)), np.zeros((0, 10))
+
+    return lambda images: [safe_detect(image) for image in images]
+
+def batched(detect, batch_size):
+    """ detect: list of images to list of (bounding boxes, landmarks), run on batch_size images at a time """
+    def detect_all(images):
+        outputs = []
+        for start in range(0, len(images), batch_size):
+            outputs.extend(detect(images[start:(start + batch_size)]))
+
+        return outputs
+
+    return detect_all
+
+def run(detect, images, repeat) -> (float, list):
+    """
+    Arguments:
+        detect: a function, list of images to list of (bounding boxes, landmarks).
+
+    Returns:
+        images/s, and the outputs of the last repeat.
+    """
+    detect(images[:1])  # warmup
+
+    start = time.time()
+    for _ in range(repeat):
+        outputs = detect(images)
+
+    return repeat * len(images) / (time.time() - start), outputs
+
+def deviation(outputs, reference) -> (int, float, float):
+    """
+    Returns:
+        number of images with different number of faces,
+        max absolute difference of the boxes (score included) and of the landmarks.
+    """
+    mismatch, box_diff, landmark_diff = 0, 0.0, 0.0
+
+    for (boxes, landmarks), (ref_boxes, ref_landmarks) in zip(outputs, reference):
+        if len(boxes) != len(ref_boxes):
+            mismatch += 1
+            continue
+
+        if len(boxes) > 0:
+            box_diff = max(box_diff, np.abs(boxes - ref_boxes).max())
+            landmark_diff = max(landmark_diff, np.abs(landmarks - ref_landmarks).max())
+
+    return mismatch, box_diff, landmark_diff
+
+def compare(variants: dict, images, repeat):
+    """ Measure each variant {name: detect function}, the first one is the reference """
+    reference, base = None, None
+
+    for name, detect in variants.items():
+        speed, outputs = run(detect, images, repeat)
+
+        if reference is None:
+            reference, base = outputs, speed
+
+        mismatch, box_diff, landmark_diff = deviation(outputs, reference)
+        print('[{:8}] {:8.2f} images/s ({:.2f}x) faces: {} mismatched images: {} max box diff: {:.4f} max landmark diff: {:.4f}'.format(
+            name, speed, speed / base, sum(len(boxes) for boxes, _ in outputs), mismatch, box_diff, landmark_diff))
+
+    return
+
+def pyramid(images, opt):
+    variants = {
+        'loop': per_image(lambda image: detect_faces(image, MODEL_PATHS, mosaic=False)),
+        'mosaic': per_image(lambda image: detect_faces(image, MODEL_PATHS, mosaic=True)),
+    }
+
+    return compare(variants, images, opt.repeat)
+
+def batch(images, opt):
+    variants = {'single': per_image(lambda image: detect_faces(image, MODEL_PATHS))}
+
+    for batch_size in opt.batch_sizes:
+        variants['batch{}'.format(batch_size)] = batched(lambda images: detect_faces_batch(images, MODEL_PATHS), batch_size)
+        variants['batch{}cl'.format(batch_size)] = batched(lambda images: detect_faces_batch(images, MODEL_PATHS, channels_last=True), batch_size)
+
+    return compare(variants, images, opt.repeat)
+
+def landmark_drift(outputs, reference, tolerance) -> dict:
+    """
+    Compare the landmarks of the first face of each image.
+
+    Returns:
+        a dict of
+            lost / found: number of images with a face in only one of them
+            mean / max: of the max absolute landmark difference (px) of each image
+            moved: number of images whose first face moved more than tolerance px
+    """
+    drifts, lost, found = [], 0, 0
+
+    for (_, landmarks), (_, ref_landmarks) in zip(outputs, reference):
+        if len(landmarks) == 0 or len(ref_landmarks) == 0:
+            lost += len(landmarks) < len(ref_landmarks)
+            found += len(landmarks) > len(ref_landmarks)
+            continue
+
+        drifts.append(np.abs(landmarks[0] - ref_landmarks[0]).max())
+
+    drifts = np.array(drifts) if len(drifts) > 0 else np.zeros(1)
+
+    return {'lost': lost, 'found': found, 'mean': drifts.mean(), 'max': drifts.max(), 'moved': int((drifts > tolerance).sum())}
+
+def early_exit(images, opt):
+    variants = {
+        'all': batched(lambda images: detect_faces_batch(images, MODEL_PATHS), opt.batch_size),
+        'first': batched(lambda images: detect_faces_batch(images, MODEL_PATHS, max_faces=1), opt.batch_size),
+    }
+
+    base, reference = None, None
+    for name, detect in variants.items():
+        speed, outputs = run(detect, images, opt.repeat)
+
+        if reference is None:
+            reference, base = outputs, speed
+
+        drift = landmark_drift(outputs, reference, opt.tolerance)
+        print('[{:8}] {:8.2f} images/s ({:.2f}x) first face landmark drift: mean {:.2f} px, max {:.2f} px, '
+              '{} images moved > {} px, {} lost, {} found'.format(
+            name, speed, speed / base, drift['mean'], drift['max'], drift['moved'], opt.tolerance, drift['lost'], drift['found']))
+
+    return
+
+def nms(images, opt):
+    # Record the inputs of the NMS calls
+    calls = []
+
+    def record(boxes, overlap_threshold = 0.5, mode = 'union'):
+        calls.append((boxes[:, 0:5].copy(), overlap_threshold, mode))
+        return box_utils.nms(boxes, overlap_threshold, mode)
+
+    for module in (detector, first_stage):
+        module.nms = record
+
+    try:
+        per_image(lambda image: detect_faces(image, MODEL_PATHS))(images)
+    finally:
+        for module in (detector, first_stage):
+            module.nms = box_utils.nms
+
+    print('{} NMS calls, {} boxes (max {})'.format(len(calls), sum(len(boxes) for boxes, _, _ in calls), max(len(boxes) for boxes, _, _ in calls)))
+
+    variants = {'rows': box_utils._nms_rows, 'matrix': box_utils._nms_matrix}
+    picks = {}
+
+    for name, suppress in variants.items():
+        start = time.time()
+        for _ in range(opt.repeat):
+            picks[name] = [list(suppress(boxes, np.argsort(boxes[:, 4])[::-1], threshold, mode)) for boxes, threshold, mode in calls]
+
+        print('[{:8}] {:8.2f} calls/s'.format(name, opt.repeat * len(calls) / (time.time() - start)))
+
+    print('Same picks: {}'.format(picks['rows'] == picks['matrix']))
+
+    return
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MTCNN detector benchmark')
+    parser.add_argument('--source_root', default='./IMDb/val', help='folder of the images (searched recursively)')
+    parser.add_argument('--num_images', default=100, type=int)
+    parser.add_argument('--repeat', default=1, type=int)
+    parser.add_argument('--threads', default=1, type=int, help='torch threads')
+
+    subparser = parser.add_subparsers(dest='command', help='Benchmark item')
+    subparser.required = True
+    subparser.add_parser('pyramid', help='P-Net once per scale vs once on the mosaic')
+
+    batch_parser = subparser.add_parser('batch', help='detect_faces vs detect_faces_batch')
+    batch_parser.add_argument('--batch_sizes', default=[4, 16], nargs='*', type=int)
+
+    early_exit_parser = subparser.add_parser('early_exit', help='all the scales vs max_faces=1')
+    early_exit_parser.add_argument('--batch_size', default=16, type=int)
+    early_exit_parser.add_argument('--tolerance', default=2.0, type=float, help='landmark drift (px) counted as moved')
+
+    subparser.add_parser('nms', help='pairwise vs row by row suppression')
+
+    opt = parser.parse_args()
+    torch.set_num_threads(opt.threads)
+
+    images = load_images(opt.source_root, opt.num_images)
+    print('{} images from {}'.format(len(images), opt.source_root))
+
+    if opt.command == 'pyramid':
+        pyramid(images, opt)
+
+    if opt.command == 'batch':
+        batch(images, opt)
+
+    if opt.command == 'early_exit':
+        early_exit(images, opt)
+
+    if opt.command == 'nms':
+        nms(images, opt)
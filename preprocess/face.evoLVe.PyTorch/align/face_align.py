@@ -1,22 +1,476 @@
 import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing as mp
 import os
+import time
 from shutil import copyfile
 
 import numpy as np
 import pandas as pd
+import torch
 from PIL import Image
 from tqdm import tqdm
 
-from align_trans import get_reference_facial_points, warp_and_crop_face
-from detector import detect_faces
+import detector
+from align_trans import get_reference_facial_points, warp_and_crop_face, warp_and_crop_faces
+from detector import detect_faces_batch
+
+MODEL_PATHS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in ('pnet.npy', 'rnet.npy', 'onet.npy')]
+
+# Bumped when the outputs of the detector change, the detections and crops of the older versions are redone
+# (2: the boxes crossing the image border were not clipped before the calibration,
+#  3: R-Net / O-Net of the batches were run on channels_last tensors, now only with --channels_last)
+DETECTOR_VERSION = 3
+
+def list_images(source_root, dest_root) -> list:
+    """
+    Mirror the folders of source_root to dest_root, copy the files (e.g. cast.json)
+    and list the images to be aligned.
+
+    Returns:
+        a list of (source image path, destination folder, image_name),
+        ordered by movie, subfolder and image_name.
+    """
+    jobs = []
+
+    for movie in sorted(os.listdir(source_root)):
+        os.makedirs(os.path.join(dest_root, movie), exist_ok=True)
+
+        for subfolder in os.listdir(os.path.join(source_root, movie)):
+            source = os.path.join(source_root, movie, subfolder)
+            dest = os.path.join(dest_root, movie, subfolder)
+
+            if not os.path.isdir(source):
+                copyfile(source, dest)
+                print('File {} copied'.format(dest))
+                continue
+
+            os.makedirs(dest, exist_ok=True)
+
+            for image_name in sorted(os.listdir(source)):
+                jobs.append((os.path.join(source, image_name), dest, image_name))
+
+    return jobs
+
+def file_checksum(path) -> str:
+    """ sha1 of the file content """
+    h = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def load_manifest(path) -> dict:
+    """
+    Read the manifest (one json record per line, appended by each run),
+    the last record of each image wins.
+
+    Returns:
+        a dict of {source image path (relative to source_root): record}
+    """
+    manifest = {}
+
+    if not os.path.exists(path):
+        return manifest
+
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be truncated if the previous run was killed
+                continue
+
+            manifest[record['image']] = record
+
+    return manifest
+
+def load_detections(path, params) -> dict:
+    """
+    Read the detections of the previous runs, they are valid only if they were
+    detected with the same params (min_face_size, thresholds, nms_thresholds, max_faces, channels_last) and DETECTOR_VERSION.
+
+    Returns:
+        a dict of {source image path (relative to source_root): (checksum, boxes [n, 5], landmarks [n, 10])}
+    """
+    if not os.path.exists(path):
+        return {}
+
+    store = np.load(path)
+
+    if json.loads(str(store['params'])) != detection_params(params):
+        print("Detections in {} are ignored, the detection params or the detector version are changed".format(path))
+        return {}
+
+    boxes = np.hstack([store['boxes'], store['scores'][:, None]])
+    landmarks, offsets = store['landmarks'], store['offsets']
+
+    return {image: (checksum, boxes[offsets[i]:offsets[i + 1]], landmarks[offsets[i]:offsets[i + 1]])
+            for i, (image, checksum) in enumerate(zip(store['images'], store['checksums']))}
+
+def check_detections(path, params, overwrite=False):
+    """
+    Refuse to overwrite a store detected with other params (e.g. a trial run with
+    max_faces), the store would only keep the detections of the current run.
+    The stores of the older DETECTOR_VERSION are redone anyway, so they are replaced.
+    """
+    if overwrite or not os.path.exists(path):
+        return
+
+    stored = json.loads(str(np.load(path)['params']))
+
+    if stored.get('detector') == DETECTOR_VERSION and stored != detection_params(params):
+        raise ValueError("Detections in {} are detected with {}, not {}. Use another store (--detections) "
+                         "or --overwrite_detections to replace it".format(path, stored, detection_params(params)))
+
+def save_detections(path, detections, params):
+    """
+    Save the detections of all images as flat arrays, the faces of the i-th image
+    are boxes[offsets[i]:offsets[i + 1]] (so as scores and landmarks).
+    """
+    images = sorted(detections)
+    counts = [len(detections[image][1]) for image in images]
+
+    boxes = np.concatenate([detections[image][1] for image in images] + [np.zeros((0, 5), np.float32)])
+    landmarks = np.concatenate([detections[image][2] for image in images] + [np.zeros((0, 10), np.float32)])
+
+    # Write to a temporary file first, then replace the old one
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, 
+        images=np.array(images, dtype=str), 
+        checksums=np.array([detections[image][0] for image in images], dtype=str),
+        offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        boxes=boxes[:, 0:4].astype(np.float32),
+        scores=boxes[:, 4].astype(np.float32),
+        landmarks=landmarks.astype(np.float32),
+        params=json.dumps(detection_params(params)))
+    os.replace(tmp_path, path)
+
+def detection_params(params) -> dict:
+    """ The params which change the detections """
+    return dict({key: params[key] for key in ('min_face_size', 'thresholds', 'nms_thresholds', 'max_faces', 'channels_last') if key in params},
+                detector=DETECTOR_VERSION)
+
+def is_done(record, source_path, dest, params) -> bool:
+    """
+    Whether the image has been aligned with the same source and params,
+    and the output still exists.
+    """
+    return (record is not None 
+        and record['status'] != 'error'
+        and record['params'] == params
+        and os.path.exists(os.path.join(dest, record['output']))
+        and record['checksum'] == file_checksum(source_path))
+
+def detect_batch(images, params) -> list:
+    """
+    Detect the faces of the images in one detect_faces_batch() call. If the batch
+    fails (e.g. an unreadable image), the images are detected one by one, and the
+    failed ones have no face.
+
+    Returns:
+        a list of (boxes [n, 5], landmarks [n, 10]), one for each image.
+    """
+    kwargs = dict(model_paths=MODEL_PATHS, min_face_size=params['min_face_size'],
+                  thresholds=params['thresholds'], nms_thresholds=params['nms_thresholds'],
+                  max_faces=params.get('max_faces'), channels_last=params.get('channels_last', False))
+
+    try:
+        return detect_faces_batch(images, **kwargs)
+    except Exception:
+        pass
+
+    faces = []
+    for img in images:
+        try:
+            faces.extend(detect_faces_batch([img], **kwargs))
+        except Exception:
+            # print("{} is discarded due to non-detected landmarks!".format(source_path))
+            faces.append(([], []))
+
+    return faces
+
+def warp_batch(images, faces, reference, crop_size) -> list:
+    """
+    Warp the first face of all the RGB images at once by warp_and_crop_faces().
+
+    Returns:
+        a list of the warped faces (np.array), None if the image is not warped
+        (not loaded, no landmarks or not RGB), to be warped by crop_image() one by one.
+    """
+    warped = [None] * len(images)
+    imgs, pts, todo = [], [], []
+
+    for i, (img, face) in enumerate(zip(images, faces)):
+        if img is None or face is None or len(face[1]) == 0 or img.mode != 'RGB':
+            continue
+
+        landmarks = face[1]
+        imgs.append(np.array(img))
+        pts.append([[landmarks[0][j], landmarks[0][j + 5]] for j in range(5)])
+        todo.append(i)
+
+    if len(todo) == 0:
+        return warped
+
+    for i, warped_face in zip(todo, warp_and_crop_faces(imgs, pts, reference, crop_size=(crop_size, crop_size))):
+        warped[i] = warped_face
+
+    return warped
+
+def align_image(img, landmarks, reference, crop_size, warped_face=None) -> (Image.Image, str):
+    """
+    Align and crop the image by the first face, resize it if no face.
+    If given, warped_face is the aligned face already warped by warp_batch().
+
+    Returns:
+        the aligned image, and the status ('cropped' or 'resized')
+    """
+    # If the landmarks cannot be detected, the img will be resized only
+    if len(landmarks) == 0:
+        return img.resize(size=((crop_size, crop_size)), resample=Image.BICUBIC), 'resized'
+
+    # Crop the images by the first landmarks information (adjustable)
+    if warped_face is None:
+        facial5points = [[landmarks[0][j], landmarks[0][j + 5]] for j in range(5)]
+        warped_face = warp_and_crop_face(np.array(img), facial5points, reference, crop_size=(crop_size, crop_size))
+
+    return Image.fromarray(warped_face), 'cropped'
+
+def crop_image(img, dest, image_name, landmarks, reference, crop_size, record, warped_face=None):
+    """
+    Align and crop the image by the first face (resize if no face), save it to dest
+    and update the status, output and landmarks of the record.
+    """
+    img, status = align_image(img, landmarks, reference, crop_size, warped_face)
+
+    if status == 'resized':
+        img.save(os.path.join(dest, image_name))
+
+        record.update(status='resized', output=image_name)
+        return
+
+    if image_name.split('.')[-1].lower() not in ['jpg', 'jpeg']: #not from jpg
+        image_name = '.'.join(image_name.split('.')[:-1]) + '.jpg'
+
+    img.save(os.path.join(dest, image_name))
+
+    record.update(status='cropped', output=image_name, landmarks=[float(x) for x in landmarks[0]])
+
+def align_images(jobs, reference, params, cached, detect=True) -> list:
+    """
+    Align and crop a batch of images by their first faces, save them to dest.
+    The images without valid cached detections are detected in one batch.
+
+    Arguments:
+        jobs: a list of (source image path, destination folder, image_name).
+        params: a dict of crop_size, min_face_size, thresholds and nms_thresholds
+            (and warp: 'grid_sample' to warp the faces of the batch at once).
+        cached: a list of (checksum, boxes, landmarks) of the previous detections (or None),
+            used if the checksum is unchanged.
+        detect: if False, only crop by the cached detections (error if no valid cache).
+
+    Returns:
+        a list of dicts, one for each job:
+            status: 'cropped', 'resized' if no landmarks are detected, or 'error'
+            output: the file name of the saved image
+            landmarks: the 10 landmarks of the face (x1..x5, y1..y5), or None
+            checksum: sha1 of the source image
+            detections: (boxes [n, 5], landmarks [n, 10]) of all the faces
+    """
+    records = [{'status': 'error', 'output': None, 'landmarks': None, 'checksum': None} for _ in jobs]
+    images, faces = [None] * len(jobs), [None] * len(jobs)
+
+    for i, ((source_path, _, _), cache) in enumerate(zip(jobs, cached)):
+        try:
+            records[i]['checksum'] = file_checksum(source_path)
+            images[i] = Image.open(source_path)
+
+            if cache is not None and cache[0] == records[i]['checksum']:
+                faces[i] = (cache[1], cache[2])
+
+            elif not detect:
+                images[i] = None
+                raise KeyError('No cached detections')
+
+        except Exception as e:
+            records[i]['error'] = repr(e)
+
+    # Detect the other images in one batch
+    todo = [i for i in range(len(jobs)) if images[i] is not None and faces[i] is None]
+    for i, face in zip(todo, detect_batch([images[i] for i in todo], params)):
+        faces[i] = face
+
+    warped = [None] * len(jobs)
+    if params.get('warp') == 'grid_sample':
+        try:
+            warped = warp_batch(images, faces, reference, params['crop_size'])
+        except Exception:
+            pass    # warped by cv2 one by one
+
+    for i, ((_, dest, image_name), record) in enumerate(zip(jobs, records)):
+        if images[i] is None:
+            continue
+
+        try:
+            bounding_boxes, landmarks = faces[i]
+            record['detections'] = (np.asarray(bounding_boxes, np.float32).reshape(-1, 5), np.asarray(landmarks, np.float32).reshape(-1, 10))
+
+            crop_image(images[i], dest, image_name, landmarks, reference, params['crop_size'], record, warped[i])
+
+        except Exception as e:
+            record['error'] = repr(e)
+
+    return records
+
+class AlignTransform(object):
+    def __init__(self, source_root, params, detections_path=None, overwrite_detections=False):
+        """
+        Align the images in memory, as a transform of the datasets (e.g. before
+        ToTensor() and Normalize()), instead of saving the crops to IMDb_resize.
+
+        The transform takes the images opened from the files under source_root, the
+        detections of the images are looked up in the detection store (by the path
+        relative to source_root and the sha1 of the file), the others are detected
+        and kept in memory, see save(). The transform runs in the threads of the
+        process which builds it, the detections of the other processes (e.g. the
+        DataLoader workers) would be lost.
+
+        Arguments:
+            source_root: the folder of the images, e.g. ./IMDb/val
+            params: a dict of crop_size, min_face_size, thresholds and nms_thresholds (and max_faces, channels_last).
+            detections_path: the detection store, e.g. <dest_root>.detections.npz of face_align.py,
+                None to detect all the images.
+            overwrite_detections: replace the store if it is detected with other params,
+                otherwise ValueError (see check_detections()).
+        """
+        self.source_root = source_root
+        self.params = params
+        self.detections_path = detections_path
+        self.reference = get_reference_facial_points(default_square = True) * params['crop_size'] / 112.
+
+        self.detections = {}
+        if detections_path is not None:
+            check_detections(detections_path, params, overwrite_detections)
+            self.detections = load_detections(detections_path, params)
+
+        self.updated = False
+        self.statuses = collections.Counter()
+
+    def __call__(self, img):
+        key = os.path.relpath(img.filename, self.source_root)
+        checksum = file_checksum(img.filename)
+        cache = self.detections.get(key)
+
+        if cache is None or cache[0] != checksum:
+            bounding_boxes, landmarks = detect_batch([img], self.params)[0]
+            cache = (checksum, np.asarray(bounding_boxes, np.float32).reshape(-1, 5), np.asarray(landmarks, np.float32).reshape(-1, 10))
+
+            self.detections[key] = cache
+            self.updated = True
+
+        img, status = align_image(img, cache[2], self.reference, self.params['crop_size'])
+        self.statuses[status] += 1
+
+        return img.convert('RGB')
+
+    def __repr__(self):
+        return '{}(source_root={}, params={})'.format(self.__class__.__name__, self.source_root, self.params)
+
+    def save(self, path=None):
+        """ Write the detections to path (default: the detection store) if there are new ones """
+        path = path or self.detections_path
+
+        if path is not None and self.updated:
+            save_detections(path, self.detections, self.params)
+            self.updated = False
+
+        return
+
+    def merge(self, path):
+        """ Add the detections saved by another transform (e.g. of a worker process) """
+        detections = load_detections(path, self.params)
+
+        for key, cache in detections.items():
+            if self.detections.get(key, (None, ))[0] != cache[0]:
+                self.detections[key] = cache
+                self.updated = True
+
+        return
+
+def init_worker(num_threads):
+    """ Load PNet / RNet / ONet once per worker process """
+    torch.set_num_threads(num_threads)
+    detector.load_models(MODEL_PATHS)
+
+def batches(jobs, detections, batch_size):
+    """
+    Yields:
+        (jobs, cached detections) of every batch_size images
+    """
+    for start in range(0, len(jobs), batch_size):
+        batch = jobs[start:(start + batch_size)]
+        yield [job for job, _ in batch], [detections.get(key) for _, key in batch]
+
+def run_serial(jobs, reference, params, detections, detect=True, batch_size=16):
+    """
+    Yields:
+        (job, record) in the order of jobs
+    """
+    for batch, cached in batches(jobs, detections, batch_size):
+        yield from zip(batch, align_images(batch, reference, params, cached, detect))
+
+def run_parallel(jobs, reference, params, detections, detect, workers, max_in_flight, batch_size=16):
+    """
+    Shard the batches of images to a process pool, at most max_in_flight images
+    are submitted but not finished.
+
+    Yields:
+        (job, record) in the order of completion
+    """
+    context = mp.get_context('spawn')
+    max_batches = max(1, max_in_flight // batch_size)
+
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker, initargs=(1, )) as executor:
+        pending = {}
+
+        for batch, cached in batches(jobs, detections, batch_size):
+            if len(pending) >= max_batches:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    yield from zip(pending.pop(future), future.result())
+
+            pending[executor.submit(align_images, batch, reference, params, cached, detect)] = batch
+
+        for future in concurrent.futures.as_completed(list(pending)):
+            yield from zip(pending.pop(future), future.result())
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = "face alignment")
     parser.add_argument("-source_root", "--source_root", help = "specify your source dir", default="./IMDb/train", type = str)
     parser.add_argument("-dest_root", "--dest_root", help = "specify your destination dir", default="./IMDb_preprocess/train", type = str)
     parser.add_argument("-crop_size", "--crop_size", help = "specify size of aligned faces, align and crop with padding", default=112, type = int)
+    parser.add_argument("-min_face_size", "--min_face_size", help = "minimum face size to detect", default=20.0, type = float)
+    parser.add_argument("-thresholds", "--thresholds", help = "face probability thresholds of P-Net, R-Net and O-Net", default=[0.6, 0.7, 0.8], nargs=3, type = float)
+    parser.add_argument("-nms_thresholds", "--nms_thresholds", help = "NMS thresholds of the 3 stages", default=[0.7, 0.7, 0.7], nargs=3, type = float)
+    parser.add_argument("-manifest", "--manifest", help = "per-image manifest to resume from (default: <dest_root>.manifest.jsonl)", default=None, type = str)
+    parser.add_argument("-detections", "--detections", help = "detection store of boxes / scores / landmarks (default: <dest_root>.detections.npz)", default=None, type = str)
+    parser.add_argument("-max_faces", "--max_faces", help = "stop the detection at the coarsest scales where this number of faces are found (e.g. 1, only the first face is cropped)", default=None, type = int)
+    parser.add_argument("-overwrite_detections", "--overwrite_detections", help = "replace the detection store if it is detected with other params (default: error)", action = "store_true")
+    parser.add_argument("-recrop", "--recrop", help = "crop by the cached detections only, without running the detector", action = "store_true")
+    parser.add_argument("-workers", "--workers", help = "number of processes, each loads the models once (1: serial)", default=1, type = int)
+    parser.add_argument("-max_in_flight", "--max_in_flight", help = "maximum number of images submitted to the workers (default: 4 x workers x batch_size)", default=None, type = int)
+    parser.add_argument("-batch_size", "--batch_size", help = "number of images detected together, R-Net / O-Net run once on the crops of all of them", default=16, type = int)
+    parser.add_argument("-channels_last", "--channels_last", help = "run R-Net / O-Net once per batch on channels_last tensors, faster on CPU, but the crops may differ by a few grey levels from the image by image detection (default)", action = "store_true")
+    parser.add_argument("-warp", "--warp", help = "cv2: warpAffine face by face, grid_sample: all the faces of a batch at once (within 1 grey level of cv2)", default="cv2", choices=["cv2", "grid_sample"], type = str)
     args = parser.parse_args()
-    
+
     source_root = args.source_root # specify your source dir
     dest_root = args.dest_root # specify your destination dir
     crop_size = args.crop_size # specify size of aligned faces, align and crop with padding
@@ -26,7 +480,7 @@ if __name__ == '__main__':
     # '.DS_Store' file Only exists in MacOS
     # cwd = os.getcwd() # delete '.DS_Store' existed in the source_root
     # os.chdir(source_root)
-    # os.system("find . -name '*.DS_Store' -type f -delete")    
+    # os.system("find . -name '*.DS_Store' -type f -delete")
     # os.chdir(cwd)
 
     if not os.path.exists(source_root):
@@ -35,60 +489,95 @@ if __name__ == '__main__':
     if not os.path.isdir(dest_root):
         os.makedirs(dest_root, exist_ok=True)
 
-    movies = sorted(os.listdir(source_root))
-    for movie in tqdm(movies):
-        source_root = os.path.join(args.source_root, movie)
+    jobs = list_images(source_root, dest_root)
 
-        if not os.path.isdir(os.path.join(dest_root, movie)):
-            os.mkdir(os.path.join(dest_root, movie))
+    # Skip the images aligned by the previous runs with the same source and params
+    params = {
+        'crop_size': crop_size, 
+        'min_face_size': args.min_face_size, 
+        'thresholds': args.thresholds, 
+        'nms_thresholds': args.nms_thresholds
+    }
 
-        for subfolder in os.listdir(source_root):
-            if not os.path.isdir(os.path.join(source_root, subfolder)):
-                copyfile(os.path.join(source_root, subfolder), os.path.join(dest_root, movie, subfolder))
-                print('File {} copied'.format(os.path.join(dest_root, movie, subfolder)))
-                continue
-            
-            if not os.path.exists(os.path.join(dest_root, movie, subfolder)):
-                os.mkdir(os.path.join(dest_root, movie, subfolder))
-            
-            crop_count = 0
-            for image_name in tqdm(sorted(os.listdir(os.path.join(source_root, subfolder)))):
-                # print("Processing\t{}".format(os.path.join(source_root, subfolder, image_name)))
-                img = Image.open(os.path.join(source_root, subfolder, image_name))
-
-                try:
-                    _, landmarks = detect_faces(img, model_paths=[
-                        './preprocess/face.evoLVe.PyTorch/align/pnet.npy', 
-                        './preprocess/face.evoLVe.PyTorch/align/rnet.npy', 
-                        './preprocess/face.evoLVe.PyTorch/align/onet.npy']
-                    )                
-                except Exception:
-                    # print("{} is discarded due to non-detected landmarks!".format(os.path.join(source_root, subfolder, image_name)))
-                    img = img.resize(size=((args.crop_size, args.crop_size)), resample=Image.BICUBIC)
-                    img.save(os.path.join(dest_root, movie, subfolder, image_name))
-
-                    continue
-                
-                # If the landmarks cannot be detected, the img will be resized only
-                if len(landmarks) == 0:
-                    # print("{} is discarded due to non-detected landmarks!".format(os.path.join(source_root, subfolder, image_name)))
-                    img = img.resize(size=((args.crop_size, args.crop_size)), resample=Image.BICUBIC)
-                    img.save(os.path.join(dest_root, movie, subfolder, image_name))
-                    
-                    continue
-                
-                # Crop the images by the first landmarks information (adjustable)
-                if len(landmarks) > 0:
-                    # print("{} have {} landmarks.".format(os.path.join(source_root, subfolder, image_name), len(landmarks)))
-                    facial5points = [[landmarks[0][j], landmarks[0][j + 5]] for j in range(5)]
-                    warped_face = warp_and_crop_face(np.array(img), facial5points, reference, crop_size=(crop_size, crop_size))
-                    img_warped = Image.fromarray(warped_face)
-
-                    if image_name.split('.')[-1].lower() not in ['jpg', 'jpeg']: #not from jpg
-                        image_name = '.'.join(image_name.split('.')[:-1]) + '.jpg'
-                    
-                    img_warped.save(os.path.join(dest_root, movie, subfolder, image_name))
-
-                    crop_count += 1
-
-            print("{} crops {:4d} / {:4d} images.".format(os.path.join(os.path.basename(dest_root), movie, subfolder), crop_count, len(os.listdir(os.path.join(source_root, subfolder)))))
+    # Only recorded if given, the previous manifests and detections stay valid
+    if args.max_faces is not None:
+        params['max_faces'] = args.max_faces
+
+    if args.warp != 'cv2':
+        params['warp'] = args.warp
+
+    if args.channels_last:
+        params['channels_last'] = True
+
+    # The images aligned by an older detector are redone
+    params['detector'] = DETECTOR_VERSION
+
+    manifest_path = args.manifest or os.path.normpath(dest_root) + '.manifest.jsonl'
+    manifest = load_manifest(manifest_path)
+
+    # Boxes, scores and landmarks of all the faces, to re-crop without detection
+    detections_path = args.detections or os.path.normpath(dest_root) + '.detections.npz'
+    check_detections(detections_path, params, args.overwrite_detections)
+    detections = load_detections(detections_path, params)
+
+    # crop / total counts of each subfolder
+    crop_counts, total_counts = collections.Counter(), collections.Counter()
+    statuses = collections.Counter()
+
+    todo = []
+    for job in jobs:
+        source_path, dest, _ = job
+        key = os.path.relpath(source_path, source_root)
+        record = manifest.get(key)
+
+        if not is_done(record, source_path, dest, params):
+            todo.append((job, key))
+            continue
+
+        crop_counts[dest] += (record['status'] == 'cropped')
+        total_counts[dest] += 1
+        statuses['skipped'] += 1
+
+    print("{} / {} images are up to date in {}".format(len(jobs) - len(todo), len(jobs), manifest_path))
+    print("{} / {} images have cached detections in {}".format(sum(key in detections for _, key in todo), len(todo), detections_path))
+
+    if args.workers > 1:
+        results = run_parallel(todo, reference, params, detections, not args.recrop, args.workers, 
+                               args.max_in_flight or 4 * args.workers * args.batch_size, args.batch_size)
+    else:
+        results = run_serial(todo, reference, params, detections, not args.recrop, args.batch_size)
+
+    start = time.time()
+    try:
+        with open(manifest_path, 'a') as f:
+            for (source_path, dest, _), record in tqdm(results, total=len(todo)):
+                key = os.path.relpath(source_path, source_root)
+
+                if 'detections' in record:
+                    detections[key] = (record['checksum'], ) + record.pop('detections')
+
+                record.update(image=key, params=params)
+
+                # Flush per image, the next run resumes from here if this run is killed
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+
+                crop_counts[dest] += (record['status'] == 'cropped')
+                total_counts[dest] += 1
+                statuses[record['status']] += 1
+
+                if record['status'] == 'error':
+                    print("{} failed: {}".format(source_path, record['error']))
+
+    finally:
+        # Keep the detections of the finished images even if the run is interrupted
+        save_detections(detections_path, detections, params)
+
+    elapsed = time.time() - start
+
+    for dest in sorted(total_counts):
+        print("{} crops {:4d} / {:4d} images.".format(os.path.relpath(dest, os.path.dirname(os.path.normpath(dest_root))), crop_counts[dest], total_counts[dest]))
+
+    print("{} images in {:.1f}s ({:.2f} images/s, {} workers): {} cropped, {} resized, {} errors, {} skipped.".format(
+        len(todo), elapsed, len(todo) / max(elapsed, 1e-9), args.workers, 
+        statuses['cropped'], statuses['resized'], statuses['error'], statuses['skipped']))
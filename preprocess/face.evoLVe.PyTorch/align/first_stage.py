@@ -2,6 +2,7 @@ import math
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from torch.autograd import Variable
 
@@ -46,6 +47,119 @@ def run_first_stage(image, net, scale, threshold) -> np.ndarray:
     return boxes[keep]
 
 
+def run_first_stage_mosaic(image, net, scales, threshold) -> list:
+    """Same as run_first_stage() for each scale, but all the scaled images
+    are packed into one mosaic, and P-Net is run once.
+
+    The P-Net outputs of each scaled image are the same as running it alone:
+    the conv1 outputs next to each image are masked by a large negative value
+    before the max pooling (ceil mode), and the outputs reading the
+    neighbours are dropped.
+
+    Arguments:
+        image: an instance of PIL.Image.
+        net: an instance of pytorch's nn.Module, P-Net.
+        scales: a list of float numbers.
+        threshold: a float number.
+
+    Returns:
+        a list of float numpy arrays of shape [n_boxes, 9] (or None), one for each scale.
+    """
+
+    if len(scales) == 0:
+        return []
+
+    # scale the images and pack them into the mosaic
+    width, height = image.size
+    imgs = []
+    for scale in scales:
+        sw, sh = math.ceil(width*scale), math.ceil(height*scale)
+        imgs.append(np.asarray(image.resize((sw, sh), Image.BILINEAR), 'float32'))
+
+    positions, (mosaic_height, mosaic_width) = _pack([img.shape[:2] for img in imgs])
+
+    mosaic = np.zeros((mosaic_height, mosaic_width, 3), 'float32')
+    for img, (top, left) in zip(imgs, positions):
+        h, w = img.shape[:2]
+        mosaic[top:(top + h), left:(left + w)] = img
+
+    mosaic = torch.FloatTensor(_preprocess(mosaic))
+
+    # P-Net. The last (partial) pooling windows of the images would take the conv1
+    # outputs next to them, so these rows / columns are masked
+    features = net.features
+    x = features.prelu1(features.conv1(mosaic))
+
+    for img, (top, left) in zip(imgs, positions):
+        h, w = img.shape[0] - 2, img.shape[1] - 2
+        if h % 2 == 1 and top + h < x.shape[2]:
+            x[:, :, top + h, left:(left + w + 1)] = -1e10
+        if w % 2 == 1 and left + w < x.shape[3]:
+            x[:, :, top:(top + h + 1), left + w] = -1e10
+
+    x = features.pool1(x)
+    x = features.prelu2(features.conv2(x))
+    x = features.prelu3(features.conv3(x))
+
+    all_probs = F.softmax(net.conv4_1(x), dim=1).data.numpy()[0, 1, :, :]
+    all_offsets = net.conv4_2(x).data.numpy()
+
+    # decode the boxes of each scale from its region of the output
+    bounding_boxes = []
+    for scale, img, (top, left) in zip(scales, imgs, positions):
+        h, w = img.shape[:2]
+        oh, ow = math.ceil((h - 2)/2) - 4, math.ceil((w - 2)/2) - 4
+        oy, ox = top // 2, left // 2
+
+        probs = all_probs[oy:(oy + oh), ox:(ox + ow)]
+        offsets = all_offsets[:, :, oy:(oy + oh), ox:(ox + ow)]
+
+        boxes = _generate_bboxes(probs, offsets, scale, threshold)
+        if len(boxes) == 0:
+            bounding_boxes.append(None)
+            continue
+
+        keep = nms(boxes[:, 0:5], overlap_threshold = 0.5)
+        bounding_boxes.append(boxes[keep])
+
+    return bounding_boxes
+
+
+def _pack(sizes):
+    """Shelf packing of the images (in decreasing size order) into a mosaic
+    as wide as the first one. The positions are even, so the 2x2 poolings of
+    P-Net are aligned with each image.
+
+    Arguments:
+        sizes: a list of (h, w).
+
+    Returns:
+        a list of (y, x), and (height, width) of the mosaic.
+    """
+
+    def even(n):
+        return n + n % 2
+
+    mosaic_width = even(sizes[0][1])
+    shelves = []    # [y, height, used width]
+    positions = []
+
+    for h, w in sizes:
+        h, w = even(h), even(w)
+
+        for shelf in shelves:
+            if h <= shelf[1] and shelf[2] + w <= mosaic_width:
+                break
+        else:
+            shelf = [sum(s[1] for s in shelves), h, 0]
+            shelves.append(shelf)
+
+        positions.append((shelf[0], shelf[2]))
+        shelf[2] += w
+
+    return positions, (sum(s[1] for s in shelves), mosaic_width)
+
+
 def _generate_bboxes(probs, offsets, scale, threshold):
     """Generate bounding boxes at places
     where there is probably a face.
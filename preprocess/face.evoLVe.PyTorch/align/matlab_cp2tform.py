@@ -255,6 +255,104 @@ def get_similarity_transform_for_cv2(src_pts, dst_pts, reflective = True):
     return cv2_trans
 
 
+
+def _solve_nonreflective_similarities(uv, xy):
+    """
+    Function:
+    ----------
+        Batched findNonreflectiveSimilarity(): solve the least squares of
+        all the point sets at once, the system of xy is shared if xy is Kx2.
+
+    Parameters:
+    ----------
+        @uv: NxKx2 np.array
+        @xy: Kx2 or NxKx2 np.array
+
+    Returns:
+    ----------
+        @trans: Nx3x3 np.array
+            transform matrices from uv to xy
+    """
+    N, M = uv.shape[0], uv.shape[1]
+
+    x, y = xy[..., 0:1], xy[..., 1:2]
+    ones, zeros = np.ones_like(x), np.zeros_like(x)
+
+    tmp1 = np.concatenate((x, y, ones, zeros), axis=-1)
+    tmp2 = np.concatenate((y, -x, zeros, ones), axis=-1)
+    X = np.concatenate((tmp1, tmp2), axis=-2)     # (N x) 2K x 4
+
+    if np.any(rank(X) < 4):
+        raise Exception("cp2tform: two Unique Points Req")
+
+    U = np.concatenate((uv[:, :, 0], uv[:, :, 1]), axis=1)[:, :, None]     # N x 2K x 1
+
+    r = np.matmul(np.linalg.pinv(X), U)[:, :, 0]     # N x 4
+    sc, ss, tx, ty = r[:, 0], r[:, 1], r[:, 2], r[:, 3]
+
+    Tinv = np.zeros((N, 3, 3))
+    Tinv[:, 0, 0], Tinv[:, 0, 1] = sc, -ss
+    Tinv[:, 1, 0], Tinv[:, 1, 1] = ss, sc
+    Tinv[:, 2, 0], Tinv[:, 2, 1], Tinv[:, 2, 2] = tx, ty, 1
+
+    T = inv(Tinv)
+    T[:, :, 2] = np.array([0, 0, 1])
+
+    return T
+
+
+def get_similarity_transforms_for_cv2(src_pts, dst_pts, reflective = True):
+    """
+    Function:
+    ----------
+        Batched get_similarity_transform_for_cv2(), for N sets of points.
+
+    Parameters:
+    ----------
+        @src_pts: NxKx2 np.array
+            source points of each face, each row is a pair of coordinates (x, y)
+        @dst_pts: Kx2 or NxKx2 np.array
+            destination points (e.g. the reference points shared by all faces)
+        reflective: True or False
+            if True:
+                use reflective similarity transform
+            else:
+                use non-reflective similarity transform
+
+    Returns:
+    ----------
+        @cv2_trans: Nx2x3 np.array
+            transform matrices from src_pts to dst_pts, could be directly used
+            for cv2.warpAffine()
+    """
+    uv = np.asarray(src_pts, np.float64)
+    xy = np.asarray(dst_pts, np.float64)
+
+    trans = _solve_nonreflective_similarities(uv, xy)
+
+    if reflective:
+        xyR = xy.copy()
+        xyR[..., 0] = -1 * xyR[..., 0]
+
+        TreflectY = np.array([
+            [-1, 0, 0],
+            [0, 1, 0],
+            [0, 0, 1]
+        ])
+
+        trans2 = np.matmul(_solve_nonreflective_similarities(uv, xyR), TreflectY)
+
+        # Same choice as findSimilarity(), where xy has been reflected in place
+        # when the norms are computed
+        uv1 = np.concatenate((uv, np.ones(uv.shape[:2] + (1, ))), axis=2)
+        norm1 = norm((np.matmul(uv1, trans) - np.concatenate((xyR, np.ones(xyR.shape[:-1] + (1, ))), axis=-1))[..., 0:2], axis=(1, 2))
+        norm2 = norm((np.matmul(uv1, trans2) - np.concatenate((xyR, np.ones(xyR.shape[:-1] + (1, ))), axis=-1))[..., 0:2], axis=(1, 2))
+
+        trans = np.where((norm1 <= norm2)[:, None, None], trans, trans2)
+
+    return trans[:, :, 0:2].transpose((0, 2, 1))
+
+
 if __name__ == '__main__':
     """
     u = [0, 6, -2]
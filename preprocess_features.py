@@ -6,24 +6,77 @@
 
   Example:
     python3.7 preprocess_features.py --dataroot ./IMDb_resize/
+
+    python3.7 preprocess_features.py --dataroot ./IMDb_resize/ --workers 4
+    >> Shard the movies to 4 processes (CPU), each pinned to 1/4 of the cores.
+
+    python3.7 preprocess_features.py --dataroot ./IMDb/ --align --crop_size 224
+    >> Align the faces of the original images in memory (MTCNN + warp of face_align.py)
+       and extract the features, without writing the crops. The detections are read from
+       and kept in ./IMDb_resize/<train / val>.detections.npz (--detections_root), the
+       store of face_align.py with its default --dest_root.
 """
 import argparse
 import csv
 import os
+import shutil
+import sys
 
 import numpy as np
+import pandas as pd
 import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
 import torchvision.transforms as transforms
 from torch.optim import lr_scheduler
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 
 import evaluate_rerank
 import final_eval
 import utils
-from imdb import CastDataset, CandDataset
-from model_res50 import FeatureExtractorFace, FeatureExtractorOrigin, Classifier
+from extraction import PipelinedExtractor, extract, extract_loader, prepare
+from imdb import CastDataset, CandDataset, calibration_images
+from model_res50 import FeatureExtractorFace, FeatureExtractorOrigin, FeatureExtractorQuantized, Classifier
+
+transform1 = transforms.Compose([
+                    # transforms.Resize((224,224), interpolation=3),
+                    transforms.ToTensor(),
+                    transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                         std=[0.229, 0.224, 0.225])
+                                         ])
+
+ALIGN_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preprocess', 'face.evoLVe.PyTorch', 'align')
+
+def build_transform(folder_name, opt):
+    '''
+      Return:
+      - transform: transform1, with the in-memory alignment (face_align.AlignTransform) first if opt.align
+    '''
+    if not opt.align:
+        return transform1
+
+    if ALIGN_ROOT not in sys.path:
+        sys.path.insert(0, ALIGN_ROOT)
+    import face_align
+
+    params = {
+        'crop_size': opt.crop_size,
+        'min_face_size': opt.min_face_size,
+        'thresholds': opt.thresholds,
+        'nms_thresholds': opt.nms_thresholds,
+    }
+
+    if opt.max_faces is not None:
+        params['max_faces'] = opt.max_faces
+
+    # The same store as face_align.py --dest_root <detections_root>/<folder_name>
+    os.makedirs(opt.detections_root, exist_ok=True)
+    detections_path = os.path.join(opt.detections_root, folder_name + '.detections.npz')
+    align = face_align.AlignTransform(os.path.join(opt.dataroot, folder_name), params, detections_path, opt.overwrite_detections)
 
-def extractor_features(castloader, candloader, cast_data, cand_data, Feature_extractor, opt, device, folder_name, model_name):
+    return transforms.Compose([align, transform1])
+
+def extractor_features(castloader, candloader, cast_data, cand_data, Feature_extractor, opt, device, folder_name, model_name, engine=None, feature_root='./feature_np/'):
     '''
       Inference by trained model, extracted features and save as .npy file.
 
@@ -32,98 +85,285 @@ def extractor_features(castloader, candloader, cast_data, cand_data, Feature_ext
       - candloader
       - cast_data: the name list of casts
       - cand_data: the name list of candidates
+      - engine: PipelinedExtractor to load the candidates, use the candloader if None
+      - feature_root: save the features to <feature_root>/<model_name>/<folder_name>/<movie>/
 
       Return: None
     '''
 
     print('Start Extracting features of {}ing dataset with model({})... '.format(folder_name, model_name))
     # os.makedirs('./feature_np/', exist_ok=True)
-    os.makedirs('./feature_np/{}/{}/'.format(model_name, folder_name), exist_ok=True)
+    os.makedirs(os.path.join(feature_root, model_name, folder_name), exist_ok=True)
     
-    Feature_extractor.eval()
-    with torch.no_grad():
-        for i, (cast, labels, mov, cast_file_name_list) in enumerate(castloader):
-            mov = mov[0]    # unpacked from batch
-            cast_file_name_list = [x[0] for x in cast_file_name_list]   # # [('tt0121765_nm0000204',), ('tt0121765_nm0000168',), ...] to ['tt0121765_nm0000204', 'tt0121765_nm0000168', ...]
-            cast_labels = np.array(labels[0])   # tensor([[1,2,3,4,5,...]]) to np.arrya([1,2,3,4,5,..])
-
-            # 1. Generate cast features
-            print("generating {}'s cast features".format(mov))
-            cast = cast.to(device)          # cast.size[1, num_cast, 3, 224, 224]
-            cast_out = Feature_extractor(cast.squeeze(0))
-            cast_out = cast_out.detach().cpu().view(-1, 2048)
-            casts_features = cast_out.numpy()
-            # Save cast features 
-            feature_path = './feature_np/{}/{}/{}/cast/'.format(model_name, folder_name, mov)
-            os.makedirs(feature_path, exist_ok=True)
-            np.save(os.path.join(feature_path, "features.npy"), casts_features)
-            np.save(os.path.join(feature_path, "names.npy"), cast_file_name_list)
-            np.save(os.path.join(feature_path, "labels.npy"), cast_labels)
-
-            print("cast_file_name_list :", cast_file_name_list)
-            print('Saved features to {}'.format(feature_path))
-            print('imgs_num({}) / file_names({})\n'.format(cast_out.size()[0], len(cast_file_name_list)))
-
-            # 2. Generate candidate features
-            print("generating {}'s candidate features".format(mov))
-            cand_data.set_mov_name_save(mov)
-            cand_out = torch.tensor([])
-            cand_file_name_list = []
-            label_list = []
-            for j, (cand, label_mapped, cand_file_name_tuple) in enumerate(candloader):
-                label_list.extend(list(label_mapped.numpy()))
-                cand_file_name_list.extend(list(cand_file_name_tuple))
-                cand = cand.to(device)
-                out = Feature_extractor(cand)
-                out = out.detach().cpu().view(-1, 2048)
-                cand_out = torch.cat((cand_out, out), dim=0)
-            candidates_features = cand_out.numpy()
-            # Save candidates features
-            feature_path = './feature_np/{}/{}/{}/candidates/'.format(model_name, folder_name, mov)
-            os.makedirs(feature_path, exist_ok=True)
-            np.save(os.path.join(feature_path, "features.npy"), candidates_features)
-            np.save(os.path.join(feature_path, "names.npy"), cand_file_name_list)
-            np.save(os.path.join(feature_path, "labels.npy"), label_list)
-
-            print('Saved features to {}'.format(feature_path))
-            print('imgs_num({}) / file_names({})\n'.format(cand_out.size()[0], len(cand_file_name_list)))
+    prepare(Feature_extractor)
+    for i, (cast, labels, mov, cast_file_name_list) in enumerate(castloader):
+        mov = mov[0]    # unpacked from batch
+        cast_file_name_list = [x[0] for x in cast_file_name_list]   # # [('tt0121765_nm0000204',), ('tt0121765_nm0000168',), ...] to ['tt0121765_nm0000204', 'tt0121765_nm0000168', ...]
+        cast_labels = np.array(labels[0])   # tensor([[1,2,3,4,5,...]]) to np.arrya([1,2,3,4,5,..])
+
+        # 1. Generate cast features
+        print("generating {}'s cast features".format(mov))
+        cast_out = extract(Feature_extractor, cast.squeeze(0), device)    # cast.size[1, num_cast, 3, 224, 224]
+        casts_features = cast_out.numpy()
+        # Save cast features 
+        feature_path = os.path.join(feature_root, model_name, folder_name, mov, 'cast')
+        os.makedirs(feature_path, exist_ok=True)
+        np.save(os.path.join(feature_path, "features.npy"), casts_features)
+        np.save(os.path.join(feature_path, "names.npy"), cast_file_name_list)
+        np.save(os.path.join(feature_path, "labels.npy"), cast_labels)
+
+        print("cast_file_name_list :", cast_file_name_list)
+        print('Saved features to {}'.format(feature_path))
+        print('imgs_num({}) / file_names({})\n'.format(cast_out.size()[0], len(cast_file_name_list)))
+
+        # 2. Generate candidate features
+        print("generating {}'s candidate features".format(mov))
+        cand_data.set_mov_name_save(mov)
+        cand_out, (label_mapped, cand_file_name_list) = extract_loader(Feature_extractor, candloader, device, engine=engine)
+        label_list = label_mapped.numpy()
+        candidates_features = cand_out.numpy()
+        # Save candidates features
+        feature_path = os.path.join(feature_root, model_name, folder_name, mov, 'candidates')
+        os.makedirs(feature_path, exist_ok=True)
+        np.save(os.path.join(feature_path, "features.npy"), candidates_features)
+        np.save(os.path.join(feature_path, "names.npy"), cand_file_name_list)
+        np.save(os.path.join(feature_path, "labels.npy"), label_list)
+
+        print('Saved features to {}'.format(feature_path))
+        print('imgs_num({}) / file_names({})\n'.format(cand_out.size()[0], len(cand_file_name_list)))
     print('Extracted all features of {} with model {}.\n'.format(folder_name, model_name))
 
+def build_extractor(model_name, opt, device, transform) -> (nn.Module, str):
+    '''
+      Return:
+      - Feature_extractor
+      - model_name: the folder name of the features, '<model_name>_int8' if quantized
+    '''
+    if model_name == 'origin':
+        Feature_extractor = FeatureExtractorOrigin(precision=opt.precision).to(device)
+    elif model_name == 'face':
+        Feature_extractor = FeatureExtractorFace(precision=opt.precision).to(device)
+
+    # Save the int8 features to feature_np/<model_name>_int8/
+    if opt.quantize:
+        print("Quantizing the feature extractor with {} train images".format(opt.calibration_size))
+        images = calibration_images(os.path.join(opt.dataroot, 'train'), transform, opt.calibration_size)
+        Feature_extractor = FeatureExtractorQuantized(Feature_extractor, images)
+        model_name = model_name + '_int8'
+
+    return Feature_extractor, model_name
+
+def build_loaders(folder_name, opt, transform, movies=None):
+    '''
+      Params:
+      - movies: extract these movies only, all movies if None
+
+      Return:
+      - test_cast, test_cand, test_cast_data, test_data
+    '''
+    test_data = CandDataset(
+        data_path=os.path.join(opt.dataroot, folder_name), transform=transform, action='save')
+                                
+    test_cand = DataLoader(
+        test_data, batch_size=opt.batchsize, shuffle=False, num_workers=opt.num_workers,
+        pin_memory=torch.cuda.is_available())
+    
+    test_cast_data = CastDataset(
+        data_path=os.path.join(opt.dataroot, folder_name), transform=transform, action='save')
+
+    cast_data = test_cast_data
+    if movies is not None:
+        cast_data = Subset(test_cast_data, [test_cast_data.movies.index(mov) for mov in movies])
+
+    test_cast = DataLoader(
+        cast_data, batch_size=1, shuffle=False, num_workers=opt.num_workers,
+        pin_memory=torch.cuda.is_available())
+
+    return test_cast, test_cand, test_cast_data, test_data
+
+def shard_movies(data_path, num_shards) -> list:
+    '''
+      Split the movies into shards with similar number of candidates
+      (the largest movie first, to the shard with the least candidates).
+
+      Return:
+      - shards: list of list of moviename
+    '''
+    sizes = {mov: len(os.listdir(os.path.join(data_path, mov, 'candidates'))) for mov in os.listdir(data_path)}
+
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+
+    for mov in sorted(sizes, key=lambda mov: -sizes[mov]):
+        i = loads.index(min(loads))
+        shards[i].append(mov)
+        loads[i] += sizes[mov]
+
+    return shards
+
+def split_cores(num_shards) -> list:
+    '''
+      Split the usable cores into contiguous subsets (i.e. the cores of a socket stay together).
+
+      Return:
+      - list of list of core id
+    '''
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    size = max(len(cores) // num_shards, 1)
+
+    return [cores[(i * size) % len(cores): (i * size) % len(cores) + size] for i in range(num_shards)]
+
+def worker(rank, movies, cores, opt, model_name, folder_name, feature_root):
+    '''
+      Extract the features of the movies in one process, pinned to the cores.
+    '''
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    print('[Worker {}] cores: {}, movies: {}'.format(rank, cores, movies))
+
+    device = torch.device('cpu')
+    transform = build_transform(folder_name, opt)
+    Feature_extractor, model_name = build_extractor(model_name, opt, device, build_transform('train', opt))
+    test_cast, test_cand, test_cast_data, test_data = build_loaders(folder_name, opt, transform, movies)
+
+    extractor_features(test_cast, test_cand, test_cast_data, test_data, Feature_extractor, opt, device, folder_name, model_name, feature_root=feature_root)
+
+    # The new detections are merged into the store by the main process
+    if opt.align:
+        transform.transforms[0].save(os.path.join(feature_root, folder_name + '.detections.npz'))
+
+def extract_parallel(opt, model_name, folder_name) -> str:
+    '''
+      Shard the movies to opt.workers processes (CPU), each process writes the
+      features to ./feature_np/.workers/<rank>/, then the movies are moved to
+      ./feature_np/<model_name>/<folder_name>/.
+
+      Return:
+      - model_name: the folder name of the features
+    '''
+    shards = shard_movies(os.path.join(opt.dataroot, folder_name), opt.workers)
+    cores = split_cores(opt.workers)
+    staging = './feature_np/.workers/'
+
+    context = mp.get_context('spawn')
+    processes = [
+        context.Process(target=worker, args=(rank, shards[rank], cores[rank], opt, model_name, folder_name, os.path.join(staging, str(rank))))
+        for rank in range(opt.workers) if len(shards[rank]) > 0
+    ]
+
+    for p in processes:
+        p.start()
+
+    for p in processes:
+        p.join()
+
+    if any(p.exitcode != 0 for p in processes):
+        raise RuntimeError('Worker exited with code {}, the features are kept in {}'.format(
+            [p.exitcode for p in processes], staging))
+
+    # Merge the outputs of the workers
+    if opt.quantize:
+        model_name = model_name + '_int8'
+
+    target = './feature_np/{}/{}/'.format(model_name, folder_name)
+    os.makedirs(target, exist_ok=True)
+
+    for rank in range(opt.workers):
+        for mov in shards[rank]:
+            path = os.path.join(target, mov)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            shutil.move(os.path.join(staging, str(rank), model_name, folder_name, mov), path)
+
+    if opt.align:
+        align = build_transform(folder_name, opt).transforms[0]
+        for rank in range(opt.workers):
+            align.merge(os.path.join(staging, str(rank), folder_name + '.detections.npz'))
+        align.save()
+
+    shutil.rmtree(staging)
+
+    return model_name
+
+def check_features(data_path, feature_path):
+    '''
+      Check the features of all the movies in data_path are in feature_path,
+      with the same number of features / names / labels as the json files,
+      and the same feature dimension.
+    '''
+    errors, dims = [], set()
+
+    for mov in sorted(os.listdir(data_path)):
+        expected = {
+            'cast': len(pd.read_json(os.path.join(data_path, mov, 'cast.json'), orient='index', typ='series')),
+            'candidates': len(pd.read_json(os.path.join(data_path, mov, 'candidate.json'), orient='index', typ='series')),
+        }
+
+        for kind, num in expected.items():
+            folder = os.path.join(feature_path, mov, kind)
+            files = [os.path.join(folder, '{}.npy'.format(f)) for f in ('features', 'names', 'labels')]
+
+            if not all(os.path.exists(f) for f in files):
+                errors.append('{}: missing files'.format(folder))
+                continue
+
+            features, names, labels = [np.load(f, mmap_mode='r') for f in files]
+            dims.add(features.shape[1:])
+
+            if not (features.shape[0] == len(names) == len(labels) == num):
+                errors.append('{}: {} features, {} names, {} labels, {} images'.format(
+                    folder, features.shape[0], len(names), len(labels), num))
+
+            if not np.isfinite(features).all():
+                errors.append('{}: features are not finite'.format(folder))
+
+    if len(dims) > 1:
+        errors.append('{}: feature dimensions {} are different'.format(feature_path, sorted(dims)))
+
+    if len(errors) > 0:
+        raise RuntimeError('Consistency check failed:\n' + '\n'.join(errors))
+
+    print('Consistency check of {} passed.'.format(feature_path))
+
 def main(opt):
     os.environ['CUDA_VISIBLE_DEVICES'] = str(opt.gpu)
-    device = torch.device("cuda:0")
-
-    transform1 = transforms.Compose([
-                        # transforms.Resize((224,224), interpolation=3),
-                        transforms.ToTensor(),
-                        transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                             std=[0.229, 0.224, 0.225])
-                                             ])
-    
+    device = torch.device('cpu') if opt.quantize or opt.workers > 1 else utils.selectDevice()
+
+    engine = PipelinedExtractor(opt.decode_threads, opt.prefetch) if opt.decode_threads > 0 else None
+
+    # One transform per folder, the faces are detected once for all the models
+    folder_transforms = {folder_name: build_transform(folder_name, opt) for folder_name in ['val', 'train']}
 
     # get fixed model
     for model_name in ['origin', 'face']:
-        if model_name == 'origin':
-            Feature_extractor = FeatureExtractorOrigin().to(device)
-        elif model_name == 'face':
-            Feature_extractor = FeatureExtractorFace().to(device)
+        # Multi-process extraction on CPU
+        if opt.workers > 1:
+            for folder_name in ['val', 'train']:
+                name = extract_parallel(opt, model_name, folder_name)
+                check_features(os.path.join(opt.dataroot, folder_name), './feature_np/{}/{}/'.format(name, folder_name))
+
+            continue
+
+        Feature_extractor, model_name = build_extractor(model_name, opt, device, folder_transforms['train'])
 
         # initialize datasets
         for folder_name in ['val', 'train']:
-            test_data = CandDataset(
-                data_path=os.path.join(opt.dataroot, folder_name), transform=transform1, action='save')
-                                        
-            test_cand = DataLoader(
-                test_data, batch_size=opt.batchsize, shuffle=False, num_workers=opt.num_workers)
-            
-            test_cast_data = CastDataset(
-                data_path=os.path.join(opt.dataroot, folder_name), transform=transform1, action='save')
-
-            test_cast = DataLoader(
-                test_cast_data, batch_size=1, shuffle=False, num_workers=opt.num_workers)
+            test_cast, test_cand, test_cast_data, test_data = build_loaders(folder_name, opt, folder_transforms[folder_name])
         
             # extract features (total 4 times)
-            extractor_features(test_cast, test_cand, test_cast_data, test_data, Feature_extractor, opt, device, folder_name, model_name)
+            extractor_features(test_cast, test_cand, test_cast_data, test_data, Feature_extractor, opt, device, folder_name, model_name, engine)
+
+            if engine is not None:
+                print(engine.summary())
+
+            check_features(os.path.join(opt.dataroot, folder_name), './feature_np/{}/{}/'.format(model_name, folder_name))
+
+            if opt.align:
+                align = folder_transforms[folder_name].transforms[0]
+                align.save()
+                print('{}: {}'.format(align, dict(align.statuses)))
         
 if __name__ == '__main__':
     
@@ -135,13 +375,33 @@ if __name__ == '__main__':
 
     # Device Setting
     parser.add_argument('--gpu', default=0, nargs='*', type=int, help='')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'], help='precision of the feature extractor forward')
+    parser.add_argument('--quantize', action='store_true', help='static int8 quantized feature extractor (CPU only)')
+    parser.add_argument('--calibration_size', default=512, type=int, help='number of train images to calibrate the quantized feature extractor')
     parser.add_argument('--num_workers', default=0, type=int, help='')
+    parser.add_argument('--workers', default=1, type=int, help='shard the movies to N processes on CPU, each pinned to a subset of the cores')
+    parser.add_argument('--decode_threads', default=0, type=int, help='load the candidates by a pipelined extractor with N decode threads (0: by the DataLoader)')
+    parser.add_argument('--prefetch', default=4, type=int, help='maximum number of batches decoded ahead of the model (with --decode_threads)')
+
+    # In-memory alignment setting (same as face_align.py)
+    parser.add_argument('--align', action='store_true', help='dataroot is the original IMDb, align the faces in memory instead of reading IMDb_resize')
+    parser.add_argument('--crop_size', default=224, type=int, help='size of the aligned faces (with --align)')
+    parser.add_argument('--min_face_size', default=20.0, type=float, help='minimum face size to detect (with --align)')
+    parser.add_argument('--thresholds', default=[0.6, 0.7, 0.8], nargs=3, type=float, help='face probability thresholds of P-Net, R-Net and O-Net (with --align)')
+    parser.add_argument('--nms_thresholds', default=[0.7, 0.7, 0.7], nargs=3, type=float, help='NMS thresholds of the 3 stages (with --align)')
+    parser.add_argument('--max_faces', default=None, type=int, help='stop the detection at the coarsest scales with this number of faces (with --align)')
+    parser.add_argument('--detections_root', default='./IMDb_resize/', type=str, help='folder of the detection stores <split>.detections.npz, shared with face_align.py (with --align)')
+    parser.add_argument('--overwrite_detections', action='store_true', help='replace the detection stores detected with other params, error if not given (with --align)')
 
     opt = parser.parse_args()
 
     # Check files here
     if not os.path.exists(opt.dataroot):
         raise IOError("{} is not exists".format(opt.dataroot))
+
+    # The detections of the DataLoader workers cannot be saved, use --decode_threads or --workers instead
+    if opt.align and opt.num_workers > 0:
+        raise ValueError("--align cannot be used with --num_workers > 0, use --decode_threads or --workers instead")
     
     utils.details(opt)
     main(opt)
\ No newline at end of file
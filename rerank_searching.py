@@ -21,45 +21,33 @@ import evaluate
 import evaluate_rerank
 import final_eval
 import utils
+from extraction import PipelinedExtractor, compose, extract, extract_loader, prepare
 from imdb import CandDataset, CastDataset
-from model_res50 import Classifier, FeatureExtractorFace
+from model_res50 import Classifier, FeatureExtractorFace, Identity, load_pipeline
 
 newline = '' if sys.platform.startswith('win') else '\n'
 
 def cosine(castloader: DataLoader, candloader: DataLoader, cast_data: CastDataset, cand_data: CandDataset, 
-    feature_extractor: nn.Module, classifier: nn.Module, opt, device, feature_dim=2048, mute=True) -> list:
+    feature_extractor: nn.Module, classifier: nn.Module, opt, device, feature_dim=2048, mute=True, engine=None) -> list:
 
     features = []
     results = []
+
+    model = prepare(compose(feature_extractor, classifier))
     
     for i, (cast, _, moviename, cast_names) in enumerate(castloader, 1):
         print("[{:3d}/{:3d}] {}".format(i, len(castloader), moviename))
 
         moviename = moviename[0]
 
-        cast = cast.to(device) # cast_size = 1, num_cast + 1, 3, 448, 448
-        cast_out = feature_extractor(cast.squeeze(0))
-        cast_out = classifier(cast_out)
-        cast_out = cast_out.detach().cpu().view(-1, feature_dim)
+        cast_out = extract(model, cast.squeeze(0), device)   # cast_size = 1, num_cast + 1, 3, 448, 448
         cast_names = [x[0] for x in cast_names]
         
         cand_data.set_mov_name_val(moviename)
         cand_data.mv = moviename
 
         # Scanning condidates
-        cand_out, cand_names = torch.tensor([]), []
-        for j, (cand, _, cand_name) in enumerate(candloader):
-            cand = cand.to(device)  # cand_size = bs, 3, w, c
-            
-            if feature_extractor is not None:
-                out = feature_extractor(cand)
-                out = classifier(out)
-            else:
-                out = classifier(cand)
-
-            out = out.detach().cpu().view(-1, feature_dim)
-            cand_out = torch.cat((cand_out, out), dim=0)
-            cand_names.extend(cand_name)   
+        cand_out, (_, cand_names) = extract_loader(model, candloader, device, engine=engine)   # cand_size = bs, 3, w, c
     
         casts_features, candidates_features = cast_out.to(device), cand_out.to(device)
         cast_names, cand_names = np.asarray(cast_names, dtype=object), np.asarray(cand_names, dtype=object)
@@ -82,7 +70,7 @@ def rerank(features, k1=40, k2=6, lambda_value=0.15, mute=True) -> list:
 
 def main(opt):
     os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpu
-    device = torch.device("cuda")
+    device = utils.selectDevice()
 
     # ------------------------- # 
     # Dataset initialize        # 
@@ -107,21 +95,29 @@ def main(opt):
         action='val'
     )
 
-    val_cand = DataLoader(val_data, batch_size=opt.batchsize, shuffle=False, num_workers=opt.num_workers)
-    val_cast = DataLoader(val_cast_data, batch_size=1, shuffle=False, num_workers=opt.num_workers)
+    val_cand = DataLoader(val_data, batch_size=opt.batchsize, shuffle=False, num_workers=opt.num_workers,
+                          pin_memory=torch.cuda.is_available())
+    val_cast = DataLoader(val_cast_data, batch_size=1, shuffle=False, num_workers=opt.num_workers,
+                          pin_memory=torch.cuda.is_available())
     
     configs = itertools.product(opt.k1, opt.k2, opt.lambda_value)
     
-    feature_extractor = FeatureExtractorFace().to(device)
-    classifier = Classifier(fc_in_features=2048, fc_out=opt.feature_dim).to(device)
+    if opt.model_script:
+        print("Pipeline read: {}".format(opt.model_script))
+        feature_extractor = load_pipeline(opt.model_script, device)
+        classifier = Identity()
+
+    else:
+        feature_extractor = FeatureExtractorFace(precision=opt.precision).to(device)
+        classifier = Classifier(fc_in_features=2048, fc_out=opt.feature_dim).to(device)
     
-    if opt.model_features:
-        print("Parameter read: {}".format(opt.model_features))
-        feature_extractor = utils.load_network(feature_extractor.cpu(), opt.model_features).to(device)
+        if opt.model_features:
+            print("Parameter read: {}".format(opt.model_features))
+            feature_extractor = utils.load_network(feature_extractor.cpu(), opt.model_features).to(device)
 
-    if opt.model_classifier:
-        print("Parameter read: {}".format(opt.model_classifier))
-        classifier = utils.load_network(classifier.cpu(), opt.model_classifier).to(device).to(device)
+        if opt.model_classifier:
+            print("Parameter read: {}".format(opt.model_classifier))
+            classifier = utils.load_network(classifier.cpu(), opt.model_classifier).to(device).to(device)
 
     feature_extractor.eval()
     classifier.eval()
@@ -129,8 +125,13 @@ def main(opt):
     # ------------------- # 
     # Cosine Similarity   # 
     # ------------------- #
+    engine = PipelinedExtractor(opt.decode_threads, opt.prefetch) if opt.decode_threads > 0 else None
+
     results, features = cosine(val_cast, val_cand, val_cast_data, val_data, 
-        feature_extractor, classifier, opt, device, feature_dim=opt.feature_dim, mute=True)
+        feature_extractor, classifier, opt, device, feature_dim=opt.feature_dim, mute=True, engine=engine)
+
+    if engine is not None:
+        print(engine.summary())
 
     path = os.path.join(opt.out_folder, 'cosine.csv')
 
@@ -189,13 +190,17 @@ if __name__ == '__main__':
     # I/O Setting (important !!!)
     parser.add_argument('--model_features', default='./models/resnet50.pth', help='model checkpoint path to extract features')    # ./model_face/net_best.pth
     parser.add_argument('--model_classifier', default='./models/classifier.pth', help='model checkpoint path to classifier')
+    parser.add_argument('--model_script', help='TorchScript pipeline exported by inference_csv.py export, replace --model_features and --model_classifier')
     parser.add_argument('--dataroot', default='./IMDb_Resize', type=str, help='Directory of dataroot')
     parser.add_argument('--feature_dim', default=2048, type=int, help='Output dimensions of FC Layer')
     parser.add_argument('--gt_file', default='./IMDb_Resize/val_GT.json', type=str, help='if gt_file is exists, measure the mAP.')
     parser.add_argument('--out_folder',  default='./inference', help='output csv folder name')
     # Device Setting
     parser.add_argument('--gpu', default='0', type=str, help='')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'], help='precision of the feature extractor forward')
     parser.add_argument('--num_workers', default=0, type=int, help='')
+    parser.add_argument('--decode_threads', default=0, type=int, help='load the candidates by a pipelined extractor with N decode threads (0: by the DataLoader)')
+    parser.add_argument('--prefetch', default=4, type=int, help='maximum number of batches decoded ahead of the model (with --decode_threads)')
     parser.add_argument('--k1', default=[20], nargs='*', type=int)
     parser.add_argument('--k2', default=[6], nargs='*', type=int)
     parser.add_argument('--lambda_value', default=[0.3], nargs='*', type=float)
@@ -19,6 +19,7 @@
   - Example:
     python3.7 train.py --batchsize 64 --weight_decay 0 --mpath ./model_features/ --log_path ./log_features/ --dataroot ./IMDb_resize/ --load_features
     python3.7 train.py --batchsize 64 --weight_decay 0 --mpath ./model_img_face/ --log_path ./log_img/ --dataroot ./IMDb_resize/ --feature_norm
+    python3.7 train.py --batchsize 64 --weight_decay 0 --mpath ./model_features/ --log_path ./log_features/ --dataroot ./IMDb_resize/ --load_features --mining semihard
 """
 import argparse
 import csv
@@ -37,6 +38,8 @@ import evaluate
 import evaluate_rerank
 import final_eval
 import utils
+from extraction import compose, extract, extract_loader, prepare
+from feature_cache import FeatureCache, is_deterministic, state_hash
 from imdb import CandDataset, CastDataset
 from model_res50 import Classifier, FeatureExtractorFace, FeatureExtractorOrigin
 from tri_loss import triplet_loss
@@ -49,10 +52,75 @@ y = {
 
 newline = '' if sys.platform.startswith('win') else '\n'
 
+def encode_cached(keys: list, load_image, feature_extractor: nn.Module, cache: FeatureCache, device) -> torch.Tensor:
+    """
+      Get the features of the images from the cache, only the missing ones
+      are loaded and passed through the feature_extractor.
+
+      Params:
+      - keys: the image paths
+      - load_image: function, load_image(i) returns the image tensor of keys[i]
+
+      Return:
+      - features: Tensor _len(keys) x 2048, on device
+    """
+    features, misses = cache.get(keys)
+
+    if len(misses) > 0:
+        images = torch.stack([load_image(i) for i in misses], dim=0).to(device)
+
+        with torch.no_grad():
+            out = feature_extractor(images).view(len(misses), -1)
+
+        cache.put([keys[i] for i in misses], out)
+        for i, feature in zip(misses, out.cpu()):
+            features[i] = feature
+
+    return torch.stack(features, dim=0).to(device)
+
+def cached_candidates(cand_data, batchsize, feature_extractor: nn.Module, cache: FeatureCache, device):
+    """
+      Same batches as the train candloader (random candidates of cand_data.mv),
+      but yield the features instead of the images, and only the candidates
+      which are not in the cache are decoded.
+
+      Yield:
+      - features: Tensor   _bs x 2048
+      - labels: Tensor     _bs
+      - indices: Tensor    _bs
+    """
+    num_cand = len(cand_data)
+
+    for start in range(0, num_cand, batchsize):
+        indices = torch.randint(0, num_cand, size=(min(batchsize, num_cand - start), ))
+        keys    = [cand_data.image_path(index) for index in indices.tolist()]
+        labels  = torch.tensor([cand_data.get_label(index) for index in indices.tolist()], dtype=torch.long)
+
+        features = encode_cached(keys, lambda i: cand_data.get_train_item(int(indices[i]))[0], 
+                                 feature_extractor, cache, device)
+
+        yield features, labels, indices
+
+def cached_casts(cast_data):
+    """
+      Same items as the train castloader (batchsize 1, in order), but the cast
+      images are not loaded, see encode_cached().
+
+      Yield:
+      - cast: None
+      - labels: Tensor   _1 x num_cast
+      - moviename: [str]
+    """
+    for moviename in cast_data.movies:
+        yield None, cast_data.labels(moviename).unsqueeze(0), [moviename]
+
 def train(castloader: DataLoader, candloader: DataLoader, cand_data, 
           feature_extractor: nn.Module, classifier: nn.Module, criterion,
-          scheduler, optimizer, epoch, device, opt, feature_dim=1024) -> (nn.Module, nn.Module, float):   
+          scheduler, optimizer, epoch, device, opt, feature_dim=1024, cache=None) -> (nn.Module, nn.Module, float):   
     """
+      Params:
+      - cache: FeatureCache, if not None, memoize the features of the fixed feature_extractor
+
       Return:
       - feature_extractor
       - classifier
@@ -60,13 +128,25 @@ def train(castloader: DataLoader, candloader: DataLoader, cand_data,
     """
     scheduler.step()
 
+    # If the feature_extractor is fixed and opt.reuse_cast_features, the casts are encoded
+    # once per movie, and only the classifier is run on them per candidate batch.
+    frozen = opt.reuse_cast_features and feature_extractor is not None and utils.is_frozen(feature_extractor)
+
     classifier.train()
     if feature_extractor is not None:
-        feature_extractor.train()
+        # The cached / reused features are only valid if the feature_extractor is deterministic,
+        # i.e. BatchNorm uses the running statistics instead of the statistics of each batch
+        if cache is not None or frozen:
+            feature_extractor.eval()
+        else:
+            feature_extractor.train()
     
     movie_loss = 0.0
+
+    # With the cache, the cast images are only loaded if their features are missing
+    casts = cached_casts(castloader.dataset) if cache is not None else castloader
     
-    for i, (cast, label_cast, moviename) in enumerate(castloader, 1):
+    for i, (cast, label_cast, moviename) in enumerate(casts, 1):
         moviename    = moviename[0]
         label_cast   = label_cast[0]
         num_cast     = len(label_cast)
@@ -77,28 +157,47 @@ def train(castloader: DataLoader, candloader: DataLoader, cand_data,
         else:
             cand_data.set_mov_name_feature(moviename)
 
-        for j, (cand, label_cand, _) in enumerate(candloader, 1):    
+        if cache is not None:
+            cast_keys    = castloader.dataset.image_paths(moviename)
+            cast_feature = encode_cached(cast_keys, lambda k: castloader.dataset.get_image(cast_keys[k]), feature_extractor, cache, device)
+            candidates   = cached_candidates(cand_data, opt.batchsize, feature_extractor, cache, device)
+        elif frozen:
+            with torch.no_grad():
+                cast_feature = feature_extractor(cast.squeeze(0).to(device))
+            candidates   = candloader
+        else:
+            candidates   = candloader
+
+        for j, (cand, label_cand, _) in enumerate(candidates, 1):    
             bs = cand.size()[0]                         # cand.shape: batchsize, 3, 224, 224
             optimizer.zero_grad()
             
-            inputs = torch.cat((cast.squeeze(0), cand), dim=0)
-            label  = torch.cat((label_cast, label_cand), dim=0).tolist()
-            inputs = inputs.to(device)
+            label  = torch.cat((label_cast, label_cand), dim=0).to(device)
+
+            # The cached candidates are the outputs of the feature_extractor already
+            if cache is not None:
+                out = classifier(torch.cat((cast_feature, cand), dim=0))
+            elif frozen:
+                with torch.no_grad():
+                    cand_feature = feature_extractor(cand.to(device))
+                out = classifier(torch.cat((cast_feature, cand_feature), dim=0))
+            else:
+                inputs = torch.cat((cast.squeeze(0), cand), dim=0).to(device)
             
-            # print('input size :', inputs.size())      # input.shape: batchsize, 3, 224, 224
+                # print('input size :', inputs.size())      # input.shape: batchsize, 3, 224, 224
             
-            if feature_extractor is not None:
-                out = feature_extractor(inputs)
-                # print("train cand feature output shape :", out.shape)
-                out = classifier(out)
-            else:
-                out = classifier(inputs)
+                if feature_extractor is not None:
+                    out = feature_extractor(inputs)
+                    # print("train cand feature output shape :", out.shape)
+                    out = classifier(out)
+                else:
+                    out = classifier(inputs)
 
             if opt.load_features:
                 _num_cast = num_cast + 1
             else:
                 _num_cast = num_cast
-            loss = triplet_loss(out, label, _num_cast, triplet_criterion=criterion)   # Size averaged loss
+            loss = triplet_loss(out, label, _num_cast, triplet_criterion=criterion, mining=opt.mining)   # Size averaged loss
             loss.backward()
             optimizer.step()
             
@@ -111,6 +210,10 @@ def train(castloader: DataLoader, candloader: DataLoader, cand_data,
         
         movie_loss += running_loss
 
+    if cache is not None:
+        cache.flush()
+        print(cache.summary())
+
     return feature_extractor, classifier, movie_loss / len(castloader)
                 
 def val(castloader: DataLoader, candloader: DataLoader, cast_data, cand_data, 
@@ -121,9 +224,8 @@ def val(castloader: DataLoader, candloader: DataLoader, cast_data, cand_data,
       - mAP:
       - loss:
     """
-    classifier.eval()
-    if feature_extractor is not None:
-        feature_extractor.eval()
+    # If train classifier only, the variable 'feature_extractor' is None and skipped
+    model = prepare(compose(feature_extractor, classifier))
     
     movie_loss = 0.0
 
@@ -134,15 +236,7 @@ def val(castloader: DataLoader, candloader: DataLoader, cast_data, cand_data,
         for i, (cast, label_cast, mov, cast_names) in enumerate(castloader, 1):
             mov = mov[0]                        # Un-packing list
             
-            cast = cast.to(device)              # cast.shape: 1, num_cast+1, 3, 448, 448
-
-            if feature_extractor is not None:
-                cast_out = feature_extractor(cast.squeeze(0))
-                # print("val cast feature output shape :", cast_out.shape)
-                cast_out = classifier(cast_out)
-            else:
-                cast_out = classifier(cast.squeeze(0))
-            cast_out = cast_out.detach().cpu().view(-1, feature_dim)
+            cast_out = extract(model, cast.squeeze(0), device)     # cast.shape: 1, num_cast+1, 3, 448, 448
             
             label_cast = torch.tensor(label_cast).squeeze(0)
             cast_names = [x[0] for x in cast_names]
@@ -150,30 +244,13 @@ def val(castloader: DataLoader, candloader: DataLoader, cast_data, cand_data,
             print("[Validating] Number of candidates should be equal to: {}".format(
                 len(os.listdir(os.path.join(opt.dataroot, 'val', mov, 'candidates')))))
 
-            cand_out    = torch.tensor([])
-            cand_labels = torch.tensor([], dtype=torch.long)
-            cand_names  = []
-
             if feature_extractor is not None:
                 cand_data.set_mov_name_val(mov)
             else:
                 cand_data.set_mov_name_feature(mov)
 
-            for j, (cand, cand_label, cand_name) in enumerate(candloader):
-                cand = cand.to(device)          # cand.shape: bs, 3, height, wigth
-
-                if feature_extractor is not None:
-                    out = feature_extractor(cand)
-                    # print("val cand feature output shape :", out.shape)
-                    out = classifier(out)
-                else:
-                    out = classifier(cand)
-
-                out = out.detach().cpu().view(-1, feature_dim)
-
-                cand_out    = torch.cat((cand_out, out), dim=0)
-                cand_labels = torch.cat((cand_labels, cand_label), dim=0)
-                cand_names.extend(cand_name)
+            # cand.shape: bs, 3, height, wigth
+            cand_out, (cand_labels, cand_names) = extract_loader(model, candloader, device)
                 
             cast_feature = cast_out.to(device)
             candidate_feature = cand_out.to(device)
@@ -268,7 +345,7 @@ def write_record(record, filename: str, folder: str):
 # ------------- #
 def main(opt):
     os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpu
-    device = torch.device("cuda")
+    device = utils.selectDevice()
     
     # ------------------------- # 
     # Dataset initialize        # 
@@ -324,9 +401,11 @@ def main(opt):
     )
     
     train_cand = DataLoader(train_data, batch_size=opt.batchsize, shuffle=True, num_workers=opt.threads)
-    val_cand   = DataLoader(val_data, batch_size=opt.batchsize, shuffle=False, num_workers=opt.threads)
+    val_cand   = DataLoader(val_data, batch_size=opt.batchsize, shuffle=False, num_workers=opt.threads,
+                            pin_memory=torch.cuda.is_available())
     train_cast = DataLoader(train_cast_data, batch_size=1, shuffle=False, num_workers=opt.threads)
-    val_cast   = DataLoader(val_cast_data, batch_size=1, shuffle=False, num_workers=opt.threads)
+    val_cast   = DataLoader(val_cast_data, batch_size=1, shuffle=False, num_workers=opt.threads,
+                            pin_memory=torch.cuda.is_available())
     
     # ------------------------- # 
     # Model, optim initialize   # 
@@ -339,11 +418,32 @@ def main(opt):
         # one way to set difference learning rate:
         # params.append({'params': feature_extractor.parameters(), 'lr': 1e-3})
         if opt.model_name == 'face':
-            feature_extractor = FeatureExtractorFace().to(device)
+            feature_extractor = FeatureExtractorFace(precision=opt.precision).to(device)
         elif opt.model_name == 'origin':
-            feature_extractor = FeatureExtractorOrigin().to(device)
+            feature_extractor = FeatureExtractorOrigin(precision=opt.precision).to(device)
         # params.append({'params': feature_extractor.parameters()})
         # print("Train the model with Feature Extractor + Classifier")
+
+    # Memoize the outputs of the fixed feature extractor
+    cache = None
+    if opt.cache_features and not opt.load_features:
+        if not is_deterministic(transform):
+            raise ValueError('Cannot cache the features with random augmentations: {}'.format(transform))
+
+        # Everything except the image path which changes the features
+        namespace = '|'.join([
+            'model: ' + opt.model_name,
+            'weights: ' + state_hash(feature_extractor),
+            'transform: ' + repr(transform),
+            'dataroot: ' + os.path.abspath(opt.dataroot),
+            'precision: ' + opt.precision,
+        ])
+
+        cache = FeatureCache(
+            namespace=namespace,
+            spill_dir=opt.cache_dir,
+            max_items=opt.cache_size
+        )
     
     optimizer = torch.optim.Adam(params,
         lr=opt.lr,
@@ -380,7 +480,7 @@ def main(opt):
         # If train classifier only, the variable 'feature_extractor' is set as None
         feature_extractor, classifier, training_loss = train(train_cast, train_cand, train_data,
                                                             feature_extractor, classifier, train_criterion,
-                                                            scheduler, optimizer, epoch, device, opt, feature_dim=opt.feature_dim)
+                                                            scheduler, optimizer, epoch, device, opt, feature_dim=opt.feature_dim, cache=cache)
             
         y['train_loss'].append(training_loss)
 
@@ -437,6 +537,7 @@ if __name__ == '__main__':
     parser.add_argument('--b2', default=0.999, type=float)
     parser.add_argument('--feature_dim', default=2048, type=int)
     parser.add_argument('--feature_norm', action='store_true')
+    parser.add_argument('--mining', default='random', choices=['random', 'hard', 'semihard'], help='how to choose the negative cast of each candidate')
     
     # I/O Setting (important !!!)
     parser.add_argument('--mpath',  default='./models', help='folder to output images and model checkpoints')
@@ -444,11 +545,16 @@ if __name__ == '__main__':
     parser.add_argument('--dataroot', default='./IMDb_resize', type=str, help='Directory of dataroot')
     parser.add_argument('--load_features', action='store_true', help='If true, dataloader will load the image in features')
     parser.add_argument('--feature_root', default='./feature_np/face/', type=str, help='Directory of features data root')
+    parser.add_argument('--cache_features', action='store_true', help='If true, memoize the outputs of the fixed feature extractor')
+    parser.add_argument('--cache_dir', default=None, type=str, help='Directory to spill the cached features and to save them for the next runs, keep all in memory if not given')
+    parser.add_argument('--cache_size', default=None, type=int, help='Maximum number of cached features in memory')
+    parser.add_argument('--reuse_cast_features', action='store_true', help='If true, encode the casts once per movie with the fixed feature extractor (in eval mode, changes the results)')
     # parser.add_argument('--gt_file', default='./IMDb_resize/val_GT.json', type=str, help='Directory of training set.')
     # parser.add_argument('--resume', type=str, help='If true, resume training at the checkpoint')
     
     # Device Setting
     parser.add_argument('--gpu', default='0', type=str, help='')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'], help='precision of the feature extractor forward')
     parser.add_argument('--threads', default=0, type=int)
 
     # Others Setting
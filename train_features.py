@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+  FileName     [ train_features.py ]
+  PackageName  [ final ]
+  Synopsis     [ Train the classifier on the features in memory (fixed the resnet-50) ]
+
+  Usage:
+  - python train_features.py --feature_root <features> --mpath <model_output>
+  >> Load all the features of the trainset once (generated by preprocess_features.py),
+     and sample the candidates batch by batch with tensor indexing.
+
+  - Example:
+    python3.7 train_features.py --batchsize 64 --weight_decay 0 --mpath ./model_features/ --log_path ./log_features/ --dataroot ./IMDb_resize/ --feature_root ./feature_np/face/
+"""
+import argparse
+import math
+import os
+
+import torch
+import torch.nn as nn
+import torchvision.transforms as transforms
+from torch.optim import lr_scheduler
+from torch.utils.data import DataLoader
+
+import utils
+from imdb import CandDataset, CastDataset, FeatureBank
+from model_res50 import Classifier
+from train import save_network, val, write_record
+from tri_loss import triplet_loss
+
+y = {
+    'train_loss': [],
+    'val_loss': [],
+    'val_mAP': []
+}
+
+def train(bank: FeatureBank, classifier: nn.Module, criterion,
+          scheduler, optimizer, epoch, opt) -> (nn.Module, float):
+    """
+      Same as train.train, but the candidates are sampled from the FeatureBank directly.
+      For each movie, draw ceil(num_cand / batchsize) batches of random candidates.
+
+      Return:
+      - classifier
+      - train_loss: average with movies
+    """
+    scheduler.step()
+
+    classifier.train()
+
+    movie_loss = 0.0
+
+    for i in torch.randperm(len(bank)).tolist():
+        cast, label_cast = bank.casts(i)
+        num_cast = cast.shape[0]
+        num_cand = bank.num_candidates(i)
+
+        # Nothing to be compared in this movie
+        if num_cast < 2 or num_cand == 0:
+            continue
+
+        running_loss = 0.0
+
+        for j in range(1, math.ceil(num_cand / opt.batchsize) + 1):
+            bs = min(opt.batchsize, num_cand - (j - 1) * opt.batchsize)
+            cand, label_cand = bank.sample(i, bs)
+            optimizer.zero_grad()
+
+            inputs = torch.cat((cast, cand), dim=0)
+            label  = torch.cat((label_cast, label_cand), dim=0)
+
+            out  = classifier(inputs)
+            loss = triplet_loss(out, label, num_cast, triplet_criterion=criterion, mining=opt.mining)   # Size averaged loss
+            loss.backward()
+            optimizer.step()
+
+            running_loss += loss.item() * bs
+
+            if j % opt.log_interval == 0:
+                print('Epoch [%d/%d] Movie [%s] Iter [%d] Loss: %.4f'
+                      % (epoch, opt.epochs, bank.movies[i], j, running_loss / ((j - 1) * opt.batchsize + bs)))
+
+        movie_loss += running_loss
+
+    return classifier, movie_loss / len(bank)
+
+# ------------- #
+# main function #
+# ------------- #
+def main(opt):
+    os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpu
+    device = utils.selectDevice()
+
+    # ------------------------- #
+    # Dataset initialize        #
+    # ------------------------- #
+    print('Loading features from {} ...'.format(os.path.join(opt.feature_root, 'train')))
+    train_bank = FeatureBank(os.path.join(opt.feature_root, 'train'), drop_others=True, device=device)
+    print('Loaded {} movies, {} casts, {} candidates.'.format(
+        len(train_bank), train_bank.cast_features.shape[0], train_bank.cand_features.shape[0]))
+
+    # Validation is the same as train.py --load_features
+    val_data = CandDataset(
+        data_path=os.path.join(opt.feature_root, 'val'),
+        drop_others=False,
+        transform=transforms.ToTensor(),
+        action='val',
+        load_feature=True
+    )
+
+    val_cast_data = CastDataset(
+        data_path=os.path.join(opt.feature_root, 'val'),
+        drop_others=False,
+        transform=transforms.ToTensor(),
+        action='val',
+        load_feature=True
+    )
+
+    val_cand = DataLoader(val_data, batch_size=opt.batchsize, shuffle=False, num_workers=opt.threads,
+                          pin_memory=torch.cuda.is_available())
+    val_cast = DataLoader(val_cast_data, batch_size=1, shuffle=False, num_workers=opt.threads,
+                          pin_memory=torch.cuda.is_available())
+
+    # ------------------------- #
+    # Model, optim initialize   #
+    # ------------------------- #
+    classifier = Classifier(
+        fc_in_features=2048, fc_out=opt.feature_dim, normalize=opt.feature_norm).to(device)
+
+    optimizer = torch.optim.Adam(classifier.parameters(),
+        lr=opt.lr,
+        weight_decay=opt.weight_decay,
+        betas=(opt.b1, opt.b2)
+    )
+
+    scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=opt.milestones, gamma=opt.gamma)
+    train_criterion = nn.TripletMarginLoss(margin=1)
+    val_criterion = nn.MSELoss(reduction='sum') # For validation only.
+
+    # ----------------------------------------- #
+    # Training                                  #
+    # ----------------------------------------- #
+    best_mAP = 0.0
+    for epoch in range(1, opt.epochs + 1):
+        # Dynamic adjust the loss margin
+        if epoch in opt.milestones:
+            i = opt.milestones.index(epoch)
+            train_criterion = nn.TripletMarginLoss(margin=opt.margin[i])
+            print('index: ', i, 'margin: ', opt.margin[i])
+
+        classifier, training_loss = train(train_bank, classifier, train_criterion,
+                                          scheduler, optimizer, epoch, opt)
+
+        y['train_loss'].append(training_loss)
+
+        # Print and log the training loss
+        record = 'Epoch [%d/%d] TrainingLoss: %.4f' % (epoch, opt.epochs, training_loss)
+        print(record)
+        write_record(record, 'train_movie_avg_loss.txt', opt.log_path)
+
+        # Save the network and validate the model performance
+        if epoch % opt.save_interval == 0:
+            name = 'classifier_{}.pth'.format(str(epoch).zfill(3))
+            save_network(classifier, name, device, opt)
+
+            val_mAP, val_loss = val(val_cast, val_cand, val_cast_data, val_data,
+                                    None, classifier, val_criterion,
+                                    epoch, opt, device, feature_dim=opt.feature_dim)
+
+            y['val_loss'].append(val_loss)
+            y['val_mAP'].append(val_mAP)
+
+            # Print and log the validation loss
+            record = 'Epoch [{}/{}] Valid_mAP: {:.2%} Valid_loss: {:.4f}\n'.format(epoch, opt.epochs, val_mAP, val_loss)
+            print(record)
+            write_record(record, 'val_mAP.txt', opt.log_path)
+
+            # Save the best model
+            if val_mAP > best_mAP:
+                save_network(classifier, 'net_best.pth', device, opt)
+                best_mAP = val_mAP
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Training on features')
+
+    # Training setting
+    parser.add_argument('--batchsize', default=64, type=int, help='batchsize in training')
+    parser.add_argument('--lr', default=5e-5, type=float, help='learning rate')
+    parser.add_argument('--milestones', default=[3, 5, 10], nargs='*', type=int)
+    parser.add_argument('--margin', default=[1.2, 1.4, 1.6], nargs='*', type=float)
+    parser.add_argument('--gamma', default=0.1, type=float)
+    parser.add_argument('--epochs', default=50, type=int)
+    parser.add_argument('--weight_decay', default=5e-4, type=float)
+    parser.add_argument('--b1', default=0.9, type=float)
+    parser.add_argument('--b2', default=0.999, type=float)
+    parser.add_argument('--feature_dim', default=2048, type=int)
+    parser.add_argument('--feature_norm', action='store_true')
+    parser.add_argument('--mining', default='random', choices=['random', 'hard', 'semihard'], help='how to choose the negative cast of each candidate')
+
+    # I/O Setting (important !!!)
+    parser.add_argument('--mpath',  default='./models', help='folder to output model checkpoints')
+    parser.add_argument('--log_path', default='./log', help='folder to output logs')
+    parser.add_argument('--dataroot', default='./IMDb_resize', type=str, help='Directory of dataroot (for val_GT.json)')
+    parser.add_argument('--feature_root', default='./feature_np/face/', type=str, help='Directory of features data root')
+
+    # Device Setting
+    parser.add_argument('--gpu', default='0', type=str, help='')
+    parser.add_argument('--threads', default=0, type=int)
+
+    # Others Setting
+    parser.add_argument('--log_interval', default=10, type=int)
+    parser.add_argument('--save_interval', default=1, type=int, help='Validation and save the network')
+
+    opt = parser.parse_args()
+
+    # Make directories
+    os.makedirs(opt.log_path, exist_ok=True)
+    os.makedirs(opt.mpath, exist_ok=True)
+
+    # Show the settings, and start to train
+    utils.details(opt)
+    main(opt)
@@ -5,19 +5,92 @@
   Synopsis     [ Self defined triplet loss loading methods. ]
 
   Example:
-    python3.7 preprocess_features.py --dataroot ./IMDb_resize/
+    python3.7 tri_loss.py
+    >> Micro-benchmark of the negative sampler
 """
+import time
+
 import torch
 import torch.nn as nn
 
-def triplet_loss(inputs, labels: list, cast_num: int, triplet_criterion, norm_criterion=None):
+def sample_negatives(index_a: torch.Tensor, cast_num: int) -> torch.Tensor:
+    """
+      Draw one negative cast index for each anchor, never equal to the anchor's label.
+
+      Draw from [0, cast_num - 1) and shift the indices which are not smaller
+      than the anchor's label by one, so no collision has to be re-rolled.
+
+      Params:
+      - index_a: LongTensor _num_cand, the labels of the anchors
+      - cast_num: int       _ number of casts
+
+      Return:
+      - index_n: LongTensor _num_cand, on the same device as index_a
+    """
+    if cast_num < 2:
+        raise ValueError('Need at least 2 casts to sample the negatives, got {}'.format(cast_num))
+
+    index_n = torch.randint(0, cast_num - 1, size=index_a.shape, device=index_a.device)
+    index_n += (index_n >= index_a).long()
+
+    return index_n
+
+def _sample_negatives_rejection(index_a: torch.Tensor, cast_num: int) -> torch.Tensor:
+    """ The old sampler (re-roll the collisions), kept for the benchmark. """
+    index_n = torch.randint(0, cast_num, size=index_a.shape, device=index_a.device)
+
+    # If index_n is equal to index_a, random again.
+    while (index_n == index_a).nonzero().shape[0] > 0:
+        n = (index_n == index_a).nonzero().shape[0]
+        index_n[index_n == index_a] = torch.randint(0, cast_num, size=(n, ), device=index_a.device)
+
+    return index_n
+
+def mine_negatives(x_a: torch.Tensor, x_p: torch.Tensor, index_a: torch.Tensor, mining='hard', margin=1.0) -> torch.Tensor:
+    """
+      Choose the negative cast of each anchor from the anchor-to-cast distance matrix.
+
+      Params:
+      - x_a: Tensor       _num_cand x dim, the candidates' features
+      - x_p: Tensor       _num_cast x dim, the casts' features
+      - index_a: Tensor   _num_cand, the labels of the anchors
+      - mining: str       _('hard' / 'semihard')
+      - margin: float     _ margin of the triplet loss, used by 'semihard'
+
+      Description:
+      - hard: the nearest negative cast.
+      - semihard: the nearest negative cast which is farther than the positive
+                  but still inside the margin, fallback to 'hard' if no such cast.
+
+      Return:
+      - index_n: LongTensor _num_cand
+    """
+    with torch.no_grad():
+        distance = torch.cdist(x_a, x_p)                                # num_cand x num_cast
+        d_ap = distance.gather(1, index_a.unsqueeze(1))                 # num_cand x 1
+
+        inf = torch.full_like(distance, float('inf'))
+        is_neg = torch.ones_like(distance, dtype=torch.bool)
+        is_neg.scatter_(1, index_a.unsqueeze(1), False)
+
+        index_n = torch.where(is_neg, distance, inf).argmin(dim=1)
+
+        if mining == 'semihard':
+            is_semihard = is_neg & (distance > d_ap) & (distance < d_ap + margin)
+            semihard_n = torch.where(is_semihard, distance, inf).argmin(dim=1)
+            index_n = torch.where(is_semihard.any(dim=1), semihard_n, index_n)
+
+    return index_n
+
+def triplet_loss(inputs, labels, cast_num: int, triplet_criterion, norm_criterion=None, mining='random'):
     """
       Self define triplet loss function.
 
       Params:
       - inputs: Tensor  _(num_cast + num_cand) x 2048
-      - labels: List    _(num_cast + num_cand) x 1
+      - labels: Tensor or List _(num_cast + num_cand) x 1
       - cast_num: int   _ number of casts
+      - mining: str     _('random' / 'hard' / 'semihard') the way to choose the negatives
 
       Description:
       - x_a: The candidates' images
@@ -29,27 +102,22 @@ def triplet_loss(inputs, labels: list, cast_num: int, triplet_criterion, norm_cr
     """
 
     batchsize = inputs.shape[0]
-    candidate_num = batchsize - cast_num
 
     inputs = inputs.reshape(batchsize, -1)
 
     x_a, x_p = inputs[cast_num:], inputs[:cast_num]
 
-    labels = torch.LongTensor(labels)
+    labels = torch.as_tensor(labels, dtype=torch.long, device=inputs.device)
 
     index_a = labels[cast_num:]
-    index_n = torch.randint(0, cast_num, size=(candidate_num, ))
+    if mining == 'random':
+        index_n = sample_negatives(index_a, cast_num)
+    elif mining in ('hard', 'semihard'):
+        index_n = mine_negatives(x_a, x_p, index_a, mining, margin=triplet_criterion.margin)
+    else:
+        raise ValueError("Wrong params 'mining'")
 
-    # If index_n is equal to index_a, random again.
-    while (index_n == index_a).nonzero().shape[0] > 0:
-        n = (index_n == index_a).nonzero().numel()
-        index_n[index_n == index_a] = torch.randint(0, cast_num, size=(n, ))
-
-    # Make the P/N Pairs with index_p and index_n
-    # print("index_n :", index_n)
-    # print("index_p :", index_p)
-    # print("x_p.shape ;", x_p.shape)
-    # print()
+    # Make the P/N Pairs with index_a and index_n
     x_p, x_n = x_p[index_a], x_p[index_n]
 
     if norm_criterion is not None:
@@ -58,3 +126,23 @@ def triplet_loss(inputs, labels: list, cast_num: int, triplet_criterion, norm_cr
       
     loss = triplet_criterion(x_a, x_p, x_n)
     return loss
+
+def sampler_benchmark(cast_nums=(2, 3, 5, 20), candidate_num=64, iters=1000, device=torch.device('cpu')):
+    """ Compare the vectorized sampler with the rejection sampler """
+    for cast_num in cast_nums:
+        index_a = torch.randint(0, cast_num, size=(candidate_num, ), device=device)
+
+        for name, sampler in (('rejection', _sample_negatives_rejection), ('vectorized', sample_negatives)):
+            start = time.time()
+            for _ in range(iters):
+                index_n = sampler(index_a, cast_num)
+            elapsed = time.time() - start
+
+            assert not (index_n == index_a).any()
+            print('[cast_num: {:3d}] {:10} {:8.2f} us/call'.format(cast_num, name, elapsed / iters * 1e6))
+        print()
+
+    return
+
+if __name__ == '__main__':
+    sampler_benchmark()
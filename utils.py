@@ -7,6 +7,7 @@
   - To tide up the codes, add some frequency used function here.
     (by Edward Lee)
 """
+import contextlib
 import os
 import torch 
 
@@ -16,6 +17,25 @@ def selectDevice():
 
     return device
 
+def autocast(device, precision='fp32'):
+    """
+      Context manager to run the forward in the given precision
+
+      Params:
+      - device: torch.device, the device of the inputs
+      - precision: 'fp32' or 'bf16' (bfloat16 autocast, works on CPU)
+
+      Return:
+      - context manager
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+
+    if precision == 'bf16':
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+    raise ValueError("Wrong params 'precision'")
+
 def load_network(network, file_path):
     """ 
       Load model parameters
@@ -26,10 +46,22 @@ def load_network(network, file_path):
       Return:
       - network: the instance of Nerual Network, with loaded parameter
     """
-    network.load_state_dict(torch.load(file_path))
+    network.load_state_dict(torch.load(file_path, map_location='cpu'))
 
     return network
 
+def is_frozen(network):
+    """
+      Check whether all the parameters of the network are fixed
+
+      Params:
+      - network: the instance of Nerual Network
+
+      Return:
+      - frozen: True if no parameter requires grad
+    """
+    return all(not param.requires_grad for param in network.parameters())
+
 def fliplr(img):
     """
       Horizontal flip the image
@@ -40,7 +72,7 @@ def fliplr(img):
       Returns:
       - img_filp: The image in torch.Tensor
     """
-    inv_idx = torch.arange(img.size(3) - 1, -1, -1).long()  # N x C x H x W
+    inv_idx = torch.arange(img.size(3) - 1, -1, -1, device=img.device).long()  # N x C x H x W
     img_flip = img.index_select(3, inv_idx)
 
     return img_flip